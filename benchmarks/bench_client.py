@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end throughput benchmark of d2c.Client.
+
+Starts benchmarks/fakeserver.py in a separate process for each archive size and runs
+query() followed by run() (or upload() with --serial) against it, with the Commons calls
+of the client pointed at the fake API. Reports assets/sec, bytes transferred, peak RSS
+of the client process and requests per asset, one JSON object per size.
+
+    python benchmarks/bench_client.py --assets 100 1000 10000 --output bench.jsonl
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from d2c.assetlist import AssetFields  # noqa: E402
+from d2c.client import Client  # noqa: E402
+from d2c.ratelimit import RateLimits  # noqa: E402
+from fakeserver import QUERY, make_server  # noqa: E402
+
+
+class BenchClient(Client):
+    """
+        Client whose Commons calls go to the fake MediaWiki API instead of pywikibot.
+    """
+
+    def __init__(self, base, **kwargs):
+        super().__init__(**kwargs)
+        self.urlDA = base
+        self.api = base + '/w/api.php'
+        self._mount()
+        self.transport.mount(self.api, self.transport.adapter())  # The Commons stand-in is not FotoWare
+
+    def _commons_exists(self, commons, use_filename):
+        data = self._S.get(self.api, params={'action': 'query', 'titles': 'File:' + use_filename,
+                                             'format': 'json', 'formatversion': 2}).json()
+        return 'missing' not in data['query']['pages'][0]
+
+    def _commons_upload(self, commons, href, description, use_filename, summary):
+        data = self._S.post(self.api, data={'action': 'upload', 'filename': use_filename, 'url': href,
+                                            'text': description, 'comment': summary, 'format': 'json',
+                                            'token': '+\\'}).json()
+        if data.get('upload', {}).get('result') != 'Success':
+            raise RuntimeError(data.get('error', data))
+
+    def _chunk_post(self, commons):
+        def post(params, chunk=None, throttle=True):
+            files = {'chunk': (params['filename'], chunk)} if chunk is not None else None
+            data = self._S.post(self.api, data=dict(params, token='+\\'), files=files).json()
+            if 'error' in data:
+                raise RuntimeError(data['error'])
+            return data
+
+        return post
+
+
+def serve(server):
+    server.serve_forever()
+
+
+def bench(base, args, result):
+    import requests
+
+    rate = (args.commons_rate, args.commons_rate, args.commons_rate)
+    fotoware = (args.fotoware_rate, args.fotoware_rate, args.fotoware_rate)
+    client = BenchClient(base, metadata_mode=args.metadata, asset_fields=AssetFields,
+                         rate_limits=RateLimits(fotoware=fotoware, commons=rate),
+                         upload_mode=args.upload, chunk_size=args.chunk_size, cache=args.cache)
+    start = time.perf_counter()
+    client.query(QUERY)
+    queried = time.perf_counter()
+    if args.serial:
+        client.upload(None, file_ending=args.rendition, summary="benchmark")
+    else:
+        client.run(None, file_ending=args.rendition, summary="benchmark",
+                   workers={'poll': args.in_flight, 'metadata': args.workers, 'upload': args.workers})
+    done = time.perf_counter()
+
+    stats = requests.get(base + '/__stats').json()
+    assets = len(client.pages)
+    result.put({
+        'assets': assets,
+        'mode': 'upload' if args.serial else 'run',
+        'metadata': args.metadata,
+        'rendition': args.rendition,
+        'upload': args.upload,
+        'query_seconds': round(queried - start, 3),
+        'seconds': round(done - start, 3),
+        'assets_per_sec': round(assets / (done - start), 2) if done > start else 0.0,
+        'bytes_from_server': stats['bytes_sent'],
+        'bytes_to_server': stats['bytes_received'],
+        'bytes_per_asset': round(stats['bytes_sent'] / assets) if assets else 0,
+        'requests': stats['requests'],
+        'requests_per_asset': round(stats['total_requests'] / assets, 2) if assets else 0.0,
+        'commons_files': stats['commons_files'],
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'cache': client.cache.stats() if client.cache is not None else None,
+        'client_metrics': client.metrics.snapshot(),
+    })
+
+
+def run_size(assets, args):
+    server = make_server(assets, args.file_size, args.pending_polls, port=args.port)
+    base = 'http://{}:{}'.format(*server.server_address)
+    server_proc = multiprocessing.Process(target=serve, args=(server,), daemon=True)
+    server_proc.start()
+    server.server_close()  # The socket lives on in the server process
+
+    result = multiprocessing.Queue()
+    client_proc = multiprocessing.Process(target=bench, args=(base, args, result))
+    client_proc.start()
+    try:
+        report = result.get(timeout=args.timeout)
+    finally:
+        client_proc.join(5)
+        if client_proc.is_alive():
+            client_proc.terminate()
+        server_proc.terminate()
+    return report
+
+
+def main():
+    arg = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg.add_argument('--assets', type=int, nargs='+', default=[100, 1000, 10000])
+    arg.add_argument('--rendition', choices=['tif', 'small_jpg', 'big_jpg'], default='tif')
+    arg.add_argument('--metadata', choices=['xmp', 'assetlist', 'verify'], default='xmp')
+    arg.add_argument('--upload', choices=['url', 'chunked'], default='url', help="upload mode of the client")
+    arg.add_argument('--chunk-size', type=int, default=4 * 1024 * 1024, help="bytes per chunk with --upload chunked")
+    arg.add_argument('--serial', action='store_true', help="use upload() instead of the run() pipeline")
+    arg.add_argument('--workers', type=int, default=4, help="threads per pipeline stage")
+    arg.add_argument('--in-flight', type=int, default=8, help="download tasks waiting on the server at the same time")
+    arg.add_argument('--file-size', type=int, default=2 * 1024 * 1024, help="bytes per TIF rendition")
+    arg.add_argument('--pending-polls', type=int, default=1, help="status requests before a task is done")
+    arg.add_argument('--commons-rate', type=float, default=1000.0,
+                     help="uploads per second allowed by the Commons rate limit, high to measure the client itself")
+    arg.add_argument('--fotoware-rate', type=float, default=1000.0,
+                     help="requests per second allowed by the FotoWare rate limit, high to measure the client itself")
+    arg.add_argument('--cache', help="HTTP cache file of the client, run twice to measure a warm cache")
+    arg.add_argument('--port', type=int, default=0, help="port of the fake server, fixed to reuse a --cache")
+    arg.add_argument('--timeout', type=float, default=3600, help="seconds allowed per archive size")
+    arg.add_argument('--output', help="append the reports to this JSON lines file")
+    args = arg.parse_args()
+
+    multiprocessing.set_start_method('fork')
+    for assets in args.assets:
+        report = run_size(assets, args)
+        line = json.dumps(report)
+        print(line)
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
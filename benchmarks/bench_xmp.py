@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the XMP to "commons_data" parser.
+
+Compares d2c.xmp.parse_xmp with the findall based parser that get_metadata used before,
+over every packet in benchmarks/xmp/ (drop more recorded packets there, one per file),
+and checks that both give the same result.
+
+    python benchmarks/bench_xmp.py [seconds per parser]
+"""
+import copy
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from d2c.xmp import parse_xmp  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xmp')
+
+BASE = {
+    'title': '',
+    'rights': [],
+    'desc': '',
+    'creator': [],
+    'DateCreated': '',
+    'Country': '',
+    'CustomField1': '',
+    'keywords': [],
+    'CustomField17': '',
+    'CustomField18': '',
+    'UserDefined233': '',
+    'IF22a_aksesjonsnummer': '',
+    'IF4b_kommentar': '',
+    'UserDefined223': '',
+    'State': '',
+    'City': '',
+    'digitalarkivetName': 'RA-bench',
+    'source': 'https://foto.digitalarkivet.no/bench.tif.info',
+    'href': 'https://foto.digitalarkivet.no/bench.tif',
+}
+
+
+def legacy_parse(packet, commons_data):
+    """
+    The parser from get_metadata before d2c.xmp.parse_xmp, kept as the reference.
+    """
+    tree = ET.fromstring(packet)
+
+    nmspdict = {'x': 'adobe:ns:meta/',
+                'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+                'dc': 'http://purl.org/dc/elements/1.1/',
+                'fwc': 'http://ns.fotoware.com/iptcxmp-custom/1.0/',
+                'fwu': 'http://ns.fotoware.com/iptcxmp-user/1.0/',
+                'photoshop': "http://ns.adobe.com/photoshop/1.0/",
+                'xmpRights': "http://ns.adobe.com/xap/1.0/rights/"}
+
+    tags = tree.findall("rdf:RDF/rdf:Description/dc:subject/rdf:Bag/rdf:li", namespaces=nmspdict)
+    tags2 = tree.findall("rdf:RDF/rdf:Description/dc:title/rdf:Alt/rdf:li", namespaces=nmspdict)
+    tags3 = tree.findall("rdf:RDF/rdf:Description/dc:creator/rdf:Seq/rdf:li", namespaces=nmspdict)
+    gjenbruk = tree.findall("rdf:RDF/rdf:Description/xmpRights:UsageTerms/rdf:Alt/rdf:li", namespaces=nmspdict)
+    rettigheter = tree.findall("rdf:RDF/rdf:Description/dc:rights/rdf:Alt/rdf:li", namespaces=nmspdict)
+    desc = tree.findall("rdf:RDF/rdf:Description/dc:description/rdf:Alt/rdf:li", namespaces=nmspdict)
+    jpg_desc = tree.findall("rdf:RDF/rdf:Description", namespaces=nmspdict)
+
+    blacklist_jpg = ['title', 'subject', 'creator', 'description']
+    for val in jpg_desc:
+        for keys2 in list(val):
+            keyRegZ = re.sub(r'{.*}', '', str(keys2.tag))
+            if keyRegZ not in blacklist_jpg and keyRegZ in commons_data:
+                if keys2.text != '\n' and keys2.tag:
+                    commons_data[keyRegZ] = keys2.text
+
+    for descAttri in tree.findall('rdf:RDF/rdf:Description', namespaces=nmspdict):
+        zipped = zip(descAttri.attrib.keys(), descAttri.attrib.values())
+        for keyZ, valZ in zipped:
+            keyRegZ = re.sub(r'{.*}', '', keyZ)
+            if keyRegZ in commons_data:
+                if valZ != '\n':
+                    commons_data[keyRegZ] = valZ
+
+    for nOrd in tags:
+        commons_data['keywords'].append(nOrd.text)
+    if tags2 and tags2[0].text:
+        commons_data['title'] = tags2[0].text
+    for creatorname in tags3:
+        commons_data['creator'].append(creatorname.text)
+    for rett in rettigheter:
+        commons_data['rights'].append(rett.text)
+    for gjen in gjenbruk:
+        commons_data['rights'].append(gjen.text)
+    if desc and desc[0].text:
+        commons_data['desc'] = desc[0].text
+
+    return commons_data
+
+
+def load_corpus():
+    packets = []
+    for filename in sorted(os.listdir(CORPUS)):
+        with open(os.path.join(CORPUS, filename), 'rb') as f:
+            packets.append((filename, f.read()))
+    return packets
+
+
+def measure(parser, packets, seconds):
+    runs = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for _, packet in packets:
+            parser(packet, copy.deepcopy(BASE))
+        runs += len(packets)
+    return runs / (time.perf_counter() - start)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    packets = load_corpus()
+
+    for filename, packet in packets:
+        old, new = legacy_parse(packet, copy.deepcopy(BASE)), parse_xmp(packet, copy.deepcopy(BASE))
+        if old != new:
+            sys.exit("Output differs for {}:\n{}\n{}".format(filename, old, new))
+
+    old = measure(legacy_parse, packets, seconds)
+    new = measure(parse_xmp, packets, seconds)
+    print("{} packets, identical output".format(len(packets)))
+    print("legacy findall parser: {:10.0f} parses/sec".format(old))
+    print("single-pass parser:    {:10.0f} parses/sec ({:.2f}x)".format(new, new / old))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for foto.digitalarkivet.no and the Commons API, for offline benchmarks.
+
+Serves a generated archive of "assets" images:
+    /fotoweb/archives/5001-bench/;o=+?q=bench      assetlist+json pages, 25 assets each, with ETag
+    /fotoweb/archives/5001-bench/RA-000001.tif.info asset records, with ETag
+    /fotoweb/me/background-tasks/                   download task creation and status
+    /fotoweb/download/...                           TIF/JPG renditions with real XMP, Range supported
+    /w/api.php                                      query (titles, allimages) and upload, by URL or in chunks
+    /__stats                                        request and byte counters as JSON
+
+    python benchmarks/fakeserver.py --assets 1000 --port 8000
+"""
+import argparse
+import hashlib
+import io
+import itertools
+import json
+import os
+import re
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+ARCHIVE = '/fotoweb/archives/5001-bench/'
+QUERY = ARCHIVE + ';o=+?q=bench'
+PAGE_SIZE = 25
+XMP_APP1_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+XMP_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xmp', 'tif_reinbeite.xml')
+
+
+class VirtualFile:
+    """
+        Image file made of a real header followed by zero bytes, so large renditions
+        can be served without keeping them in memory.
+    """
+
+    def __init__(self, head, size, tail=b''):
+        self.head = head
+        self.tail = tail
+        self.size = max(size, len(head) + len(tail))
+
+    def read(self, start, end):
+        """
+        Bytes from "start" up to, not including, "end".
+        """
+        end = min(end, self.size)
+        if start >= end:
+            return b''
+        out = bytearray()
+        if start < len(self.head):
+            out += self.head[start:min(end, len(self.head))]
+        tail_start = self.size - len(self.tail)
+        zeros = min(end, tail_start) - max(start, len(self.head))
+        if zeros > 0:
+            out += bytes(zeros)
+        if end > tail_start:
+            out += self.tail[max(start, tail_start) - tail_start:end - tail_start]
+        return bytes(out)
+
+
+def tiff_file(xmp, size):
+    """
+    Little-endian grayscale TIFF of about "size" bytes with "xmp" in tag 700.
+    """
+    width = 1024
+    height = max(1, size // width)
+    entries = [(256, 3, 1, width), (257, 3, 1, height), (258, 3, 1, 8), (259, 3, 1, 1), (262, 3, 1, 1),
+               (273, 4, 1, 0), (277, 3, 1, 1), (278, 3, 1, height), (279, 4, 1, width * height), (700, 1, len(xmp), 0)]
+    ifd_size = 2 + 12 * len(entries) + 4
+    xmp_offset = 8 + ifd_size
+    strip_offset = xmp_offset + len(xmp) + len(xmp) % 2
+
+    ifd = struct.pack('<H', len(entries))
+    for tag, field_type, count, value in entries:
+        if tag == 273:
+            value = strip_offset
+        elif tag == 700:
+            value = xmp_offset
+        if field_type == 3:
+            ifd += struct.pack('<HHIHH', tag, field_type, count, value, 0)
+        else:
+            ifd += struct.pack('<HHII', tag, field_type, count, value)
+    ifd += struct.pack('<I', 0)
+
+    head = b'II' + struct.pack('<HI', 42, 8) + ifd + xmp + b'\x00' * (len(xmp) % 2)
+    return VirtualFile(head, strip_offset + width * height)
+
+
+_jpeg_base = None
+
+
+def jpeg_file(xmp):
+    """
+    Small JPEG made with Pillow, with "xmp" in an APP1 segment.
+    """
+    global _jpeg_base
+    if _jpeg_base is None:
+        from PIL import Image
+        buf = io.BytesIO()
+        Image.new('L', (800, 600)).save(buf, 'JPEG')
+        _jpeg_base = buf.getvalue()
+    segment = XMP_APP1_HEADER + xmp
+    head = b'\xff\xd8\xff\xe1' + struct.pack('>H', len(segment) + 2) + segment + _jpeg_base[2:]
+    return VirtualFile(head, len(head))
+
+
+class Archive:
+    """
+        Generated assets, download tasks, Commons files and the counters of the server.
+    """
+
+    def __init__(self, assets, file_size, pending_polls):
+        self.assets = assets
+        self.file_size = file_size
+        self.pending_polls = pending_polls
+        with open(XMP_TEMPLATE, 'rb') as f:
+            self.xmp_template = f.read()
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+        self.commons = set()
+        self.stash = {}  # filekey -> bytes received of a chunked upload
+        self.stash_keys = itertools.count(1)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    def count(self, route, sent, received):
+        with self.lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'total_requests': sum(self.requests.values()),
+                    'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                    'commons_files': len(self.commons)}
+
+    @staticmethod
+    def name(i):
+        return 'RA-{:06d}'.format(i)
+
+    def record(self, i):
+        name = self.name(i)
+        return {
+            'href': ARCHIVE + name + '.tif.info',
+            'filename': name + '.tif',
+            'modified': '2020-01-01T00:00:{:02d}Z'.format(i % 60),
+            'metadata': {
+                '5': {'value': 'Reinflokk {}'.format(i)},
+                '25': {'value': ['Reinbeite', 'Rein', 'Samer', 'Reindrift']},
+                '80': {'value': ['Holmboe, Jens']},
+                '116': {'value': ['Falt i det fri']},
+                '361': {'value': ['CC0']},
+                '120': {'value': 'Reinflokk fotografert under befaring for reinbeitekommisjonen.'},
+                '55': {'value': '1935-06-12'},
+                '90': {'value': 'Karasjok'},
+                '95': {'value': 'Finnmark'},
+                '101': {'value': 'Norge'},
+                '301': {'value': 'Glassplatenegativ'},
+                '317': {'value': 'Arkivverket'},
+                '318': {'value': 'Reinbeitekommisjonen'},
+                '223': {'value': 'URN:NBN:no-a1450-rg1{:07d}'.format(i)},
+                '233': {'value': 'Nei'},
+                '822': {'value': 'RA/PA-0123/U/L0004'},
+                '804': {'value': 'Negativ nr. {}'.format(i)},
+            },
+        }
+
+    def page(self, nr):
+        last = max(0, (self.assets - 1) // PAGE_SIZE)
+        link = ARCHIVE + ';o=+;p={}?q=bench'
+        return {
+            'data': [self.record(i) for i in range(nr * PAGE_SIZE, min(self.assets, (nr + 1) * PAGE_SIZE))],
+            'paging': {'prev': link.format(nr - 1) if nr > 0 else '', 'next': link.format(nr + 1) if nr < last else '',
+                       'first': link.format(0), 'last': link.format(last)},
+        }
+
+    def rendition(self, name, ext):
+        i = int(name.split('-')[1])
+        xmp = self.xmp_template.replace(b'Reinflokk ved Karasjok', 'Reinflokk {}'.format(i).encode())
+        return tiff_file(xmp, self.file_size) if ext == 'tif' else jpeg_file(xmp)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    archive = None
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, route, code, body, content_type='application/json', headers=None, received=0):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        if route:
+            self.archive.count(route, len(body), received)
+
+    def _send_validated(self, route, body):
+        body = json.dumps(body).encode()
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:16])
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(route + '_304', 304, b'', headers={'ETag': etag})
+        self._send(route, 200, body, headers={'ETag': etag})
+
+    def do_GET(self):
+        self._handle(b'')
+
+    def do_POST(self):
+        self._handle(self._body())
+
+    def _handle(self, body):
+        url = urlsplit(self.path)
+        path = url.path
+        if path == '/__stats':
+            return self._send(None, 200, self.archive.stats())
+        if path == '/__reset':
+            self.archive.reset()
+            return self._send(None, 200, {})
+        if path == '/w/api.php':
+            return self._api(url, body)
+        if path.startswith('/fotoweb/me/background-tasks/'):
+            return self._task(path, body)
+        if path.startswith('/fotoweb/download/'):
+            return self._download(path)
+        if path.startswith(ARCHIVE) and path.endswith('.tif.info'):
+            i = int(path[len(ARCHIVE):-len('.tif.info')].split('-')[1])
+            return self._send_validated('asset', self.archive.record(i))
+        if path.startswith(ARCHIVE):
+            nr = re.search(r';p=(\d+)', path)
+            return self._send_validated('assetlist', self.archive.page(int(nr[1]) if nr else 0))
+        self._send('other', 404, {'message': 'not found'})
+
+    def _task(self, path, body):
+        archive = self.archive
+        if self.command == 'POST':
+            assets = json.loads(body)['request']['assets']
+            files = []
+            for asset in assets:
+                src = asset['href'].split('/__renditions/')[0]
+                name = src[len(ARCHIVE):-len('.tif.info')]
+                ext = 'tif' if '06df8390' in asset['href'] else 'jpg'
+                files.append({'src': src, 'href': '/fotoweb/download/{}/{}.{}'.format(ext, name, ext)})
+            with archive.lock:
+                job = next(archive.job_ids)
+                archive.jobs[job] = {'files': files, 'polls': 0}
+            return self._send('task_create', 200, {'location': '/fotoweb/me/background-tasks/{}'.format(job)},
+                              received=len(body))
+
+        job = archive.jobs.get(int(path.rstrip('/').rsplit('/', 1)[1]))
+        if job is None:
+            return self._send('task_status', 404, {'message': 'no such task'})
+        job['polls'] += 1
+        if job['polls'] <= archive.pending_polls:
+            return self._send('task_status', 200, {'job': {'status': 'pending'}})
+        return self._send('task_status', 200, {'job': {'status': 'done', 'result': {'files': job['files']}}})
+
+    def _download(self, path):
+        _, _, _, ext, filename = path.split('/', 4)
+        f = self.archive.rendition(filename.rsplit('.', 1)[0], ext)
+        content_type = 'image/tiff' if ext == 'tif' else 'image/jpeg'
+
+        ranged = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if ranged:
+            start = int(ranged[1])
+            end = int(ranged[2]) + 1 if ranged[2] else f.size
+            if start >= f.size:
+                return self._send('rendition', 416, b'', content_type, {'Content-Range': 'bytes */{}'.format(f.size)})
+            end = min(end, f.size)
+            return self._send('rendition', 206, f.read(start, end), content_type,
+                              {'Content-Range': 'bytes {}-{}/{}'.format(start, end - 1, f.size)})
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(f.size))
+        self.end_headers()
+        sent = 0
+        try:
+            for pos in range(0, f.size, 65536):
+                chunk = f.read(pos, pos + 65536)
+                self.wfile.write(chunk)
+                sent += len(chunk)
+        except (BrokenPipeError, ConnectionResetError):  # Client read only what it needed
+            self.close_connection = True
+        self.archive.count('rendition', sent, 0)
+
+    def _api(self, url, body):
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        content_type = self.headers.get('Content-Type', '')
+        if body and content_type.startswith('application/x-www-form-urlencoded'):
+            params.update({key: values[-1] for key, values in parse_qs(body.decode()).items()})
+        elif body and content_type.startswith('multipart/form-data'):
+            params.update(parse_multipart(body, content_type))
+
+        archive = self.archive
+        action = params.get('action')
+        if action == 'query' and 'titles' in params:
+            pages = []
+            for title in params['titles'].split('|'):
+                name = title.split(':', 1)[1].replace('_', ' ')
+                page = {'ns': 6, 'title': 'File:' + name}
+                if name not in archive.commons:
+                    page['missing'] = True
+                pages.append(page)
+            return self._send('api_query', 200, {'batchcomplete': True, 'query': {'pages': pages}}, received=len(body))
+        if action == 'query' and params.get('list') == 'allimages':
+            return self._send('api_query', 200, {'batchcomplete': True, 'query': {'allimages': []}},
+                              received=len(body))
+        if action == 'upload' and (params.get('checkstatus') or 'chunk' in params):
+            return self._send('api_chunk', 200, self._chunk(params), received=len(body))
+        if action == 'upload':
+            name = params.get('filename', '').replace('_', ' ')
+            with archive.lock:
+                if params.get('filekey'):
+                    archive.stash.pop(params['filekey'], None)
+                archive.commons.add(name)
+            return self._send('api_upload', 200, {'upload': {'result': 'Success', 'filename': name}},
+                              received=len(body))
+        self._send('api_other', 200, {'error': {'code': 'badvalue', 'info': 'unsupported request'}},
+                   received=len(body))
+
+
+    def _chunk(self, params):
+        archive = self.archive
+        with archive.lock:
+            key = params.get('filekey') or 'stash{}'.format(next(archive.stash_keys))
+            received = archive.stash.setdefault(key, 0)
+            if params.get('checkstatus'):
+                return {'upload': {'result': 'Continue', 'offset': received, 'filekey': key}}
+            if int(params['offset']) != received:
+                return {'error': {'code': 'stashfailed', 'info': 'offset mismatch', 'offset': received}}
+            received += len(params['chunk'])
+            archive.stash[key] = received
+        result = 'Success' if received >= int(params['filesize']) else 'Continue'
+        return {'upload': {'result': result, 'offset': received, 'filekey': key}}
+
+
+def parse_multipart(body, content_type):
+    """
+    Text fields of a multipart/form-data body, the file field is kept as bytes.
+    """
+    boundary = content_type.split('boundary=', 1)[1].strip('"').encode()
+    fields = {}
+    for part in body.split(b'--' + boundary):
+        if b'\r\n\r\n' not in part:
+            continue
+        head, value = part.split(b'\r\n\r\n', 1)
+        name = re.search(rb'name="([^"]*)"', head)
+        if not name:
+            continue
+        value = value[:-2] if value.endswith(b'\r\n') else value
+        fields[name[1].decode()] = value if b'filename=' in head else value.decode()
+    return fields
+
+
+def make_server(assets=1000, file_size=2 * 1024 * 1024, pending_polls=1, host='127.0.0.1', port=0):
+    """
+    make_server
+    @param assets: Amount of images in the archive.
+    @type assets: int
+    @param file_size: Size in bytes of each TIF rendition.
+    @type file_size: int
+    @param pending_polls: Amount of status requests that answer "pending" before a download task is done.
+    @type pending_polls: int
+
+    :return: return the server, not started yet, use "serve_forever"
+    :rtype: the return type ThreadingHTTPServer
+    """
+    handler = type('BenchHandler', (Handler,), {'archive': Archive(assets, file_size, pending_polls)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    arg = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg.add_argument('--assets', type=int, default=1000)
+    arg.add_argument('--file-size', type=int, default=2 * 1024 * 1024)
+    arg.add_argument('--pending-polls', type=int, default=1)
+    arg.add_argument('--port', type=int, default=8000)
+    args = arg.parse_args()
+    server = make_server(args.assets, args.file_size, args.pending_polls, port=args.port)
+    print("Serving {} assets on http://127.0.0.1:{}{}".format(args.assets, server.server_address[1], QUERY))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# FotoWare field IDs for each key in "commons_data". IPTC fields use their standard
+# FotoWare numbers, the archive specific fields use the numbers of the Digitalarkivet
+# field set. Several IDs for one key are read in order and combined (lists) or the first
+# non-empty one is used (text).
+AssetFields = {
+    'title': ['5'],
+    'desc': ['120'],
+    'keywords': ['25'],
+    'creator': ['80'],
+    'rights': ['116', '361'],
+    'DateCreated': ['55'],
+    'City': ['90'],
+    'State': ['95'],
+    'Country': ['101'],
+    'CustomField1': ['301'],
+    'CustomField17': ['317'],
+    'CustomField18': ['318'],
+    'UserDefined223': ['223'],
+    'UserDefined233': ['233'],
+    'IF22a_aksesjonsnummer': ['822'],
+    'IF4b_kommentar': ['804'],
+}
+
+ListFields = ('keywords', 'creator', 'rights')
+
+# Value of "UserDefined233" (Restriksjon) that keeps an image from being uploaded.
+Restricted = 'Ja'
+
+# Keys that are not read from the metadata itself, and therefore never compared.
+LinkFields = ('digitalarkivetName', 'source', 'href')
+
+
+def _values(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [val for val in value if val not in (None, '')]
+    return [value] if value != '' else []
+
+
+def asset_metadata(record, commons_data, fields=None):
+    """
+    asset_metadata
+    @param record: Asset from an "assetlist+json" page or a ".info" request.
+    @type record: dict
+    @param commons_data: Metadata dict with the link fields filled in, updated in place.
+    @type commons_data: dict
+    @param fields: FotoWare field IDs for each key. Default "AssetFields".
+    @type fields: dict
+
+    :return: returns a JSON object with metadata, marked as restricted if the record has no restriction field
+    :rtype: the return type dict
+    """
+    fields = AssetFields if fields is None else fields
+    metadata = record.get('metadata') or {}
+
+    for key, field_ids in fields.items():
+        found = []
+        for field_id in field_ids:
+            field = metadata.get(field_id)
+            if field:
+                found.extend(_values(field.get('value')))
+
+        if key in ListFields:
+            commons_data[key] = found
+        elif found:
+            commons_data[key] = str(found[0])
+
+    # Without the restriction field there is no telling whether the image may be shared, so it is not uploaded
+    if not any(field_id in metadata for field_id in fields.get('UserDefined233', [])):
+        commons_data['UserDefined233'] = Restricted
+
+    return commons_data
+
+
+def diff_metadata(first, second):
+    """
+    diff_metadata
+    @param first: Metadata from one source, e.g. the asset list.
+    @type first: dict
+    @param second: Metadata from the other source, e.g. the XMP packet.
+    @type second: dict
+
+    :return: returns the keys where the two disagree, mapped to (first, second)
+    :rtype: the return type dict
+    """
+    diff = {}
+    for key in first.keys() | second.keys():
+        if key in LinkFields:
+            continue
+        val1, val2 = first.get(key), second.get(key)
+        if isinstance(val1, list) or isinstance(val2, list):
+            same = [str(v).strip() for v in _values(val1)] == [str(v).strip() for v in _values(val2)]
+        else:
+            same = (val1 or '').strip() == (val2 or '').strip()
+        if not same:
+            diff[key] = (val1, val2)
+    return diff
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+import hashlib
+import tempfile
+import time
+
+from .tasks import Backoff
+
+
+class Spooled:
+    """
+        One rendition read from FotoWare into a temp file, with its size and SHA-1.
+
+        The file stays in memory up to "max_memory" bytes and is moved to disk after that.
+    """
+
+    def __init__(self, href, file, size, sha1):
+        self.href = href
+        self.file = file
+        self.size = size
+        self.sha1 = sha1
+
+    def read(self, offset, size):
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+
+def spool(session, url, max_memory=32 * 1024 * 1024, block_size=1024 * 1024, timeout=None, metrics=None):
+    """
+    spool
+    @param session: Session used for the download.
+    @type session: requests.Session
+    @param url: Address of the rendition.
+    @type url: str
+    @param max_memory: Bytes kept in memory before the file is moved to disk.
+    @type max_memory: int
+    @param block_size: Bytes read from the response at a time.
+    @type block_size: int
+    @param timeout: Seconds for connecting and between two blocks. Default no timeout.
+    @type timeout: float
+    @param metrics: Metrics the transferred bytes are counted in.
+    @type metrics: d2c.metrics.Metrics
+
+    :return: return the spooled file, its size and SHA-1, hashed while it was read
+    :rtype: the return type Spooled
+    """
+    sha1 = hashlib.sha1()
+    size = 0
+    file = tempfile.SpooledTemporaryFile(max_size=max_memory, prefix='d2c-')
+    try:
+        with session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            for block in response.iter_content(block_size):
+                sha1.update(block)
+                file.write(block)
+                size += len(block)
+    except BaseException:
+        file.close()
+        raise
+    if metrics is not None:
+        metrics.incr('bytes_spooled', size)
+    return Spooled(url, file, size, sha1.hexdigest())
+
+
+def site_post(site):
+    """
+    site_post
+    @param site: site that is used for upload
+    @type site: pywikibot.site.APISite
+
+    :return: return a "post" function for ChunkedUpload that sends the requests through pywikibot
+    :rtype: the return type callable
+    """
+    def post(params, chunk=None, throttle=True):
+        params = dict(params, token=site.tokens['csrf'])
+        mime = None
+        if chunk is not None:
+            mime = {'chunk': (chunk, ('application', 'octet-stream'), {'filename': params['filename']})}
+        return site._request(throttle=throttle, mime=mime, parameters=params).submit()
+
+    return post
+
+
+class ChunkedUploadError(Exception):
+    """
+        A chunked upload that failed after every retry. "filekey" and "offset" tell
+        where it stopped, so it can be resumed from the upload stash later.
+    """
+
+    def __init__(self, message, filekey=None, offset=0):
+        super().__init__(message)
+        self.filekey = filekey
+        self.offset = offset
+
+
+class ChunkedUpload:
+    """
+        Uploads a spooled file to Commons in chunks through the upload stash.
+
+        A chunk that fails is sent again from the offset the server has, so a dropped
+        connection only costs one chunk. The file key of each unfinished upload is kept
+        per file name, and a later upload of the same bytes continues from it.
+
+        Example usage:
+            uploader = ChunkedUpload(site_post(commons), chunk_size=8 * 1024 * 1024)
+            uploader.upload(spool(session, href), use_filename, description, summary)
+    """
+
+    def __init__(self, post, chunk_size=4 * 1024 * 1024, retries=3, backoff=None):
+        """
+        __init__
+        @param post: Function sending one API request, called as post(params, chunk=None, throttle=True)
+            and returning the decoded JSON response. See "site_post".
+        @type post: callable
+        @param chunk_size: Bytes per chunk.
+        @type chunk_size: int
+        @param retries: Amount of times one chunk is sent again after an error.
+        @type retries: int
+        @param backoff: Delay before each retry. Default "Backoff(1, 30, 2)".
+        @type backoff: Backoff
+        """
+        self.post = post
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff or Backoff(1.0, 30.0, 2.0)
+        self.stash = {}  # filename -> (sha1, filekey, offset) of uploads that did not finish
+
+    def _offset(self, filekey):
+        """
+        Ask the server how many bytes of the stashed upload it has.
+        """
+        try:
+            data = self.post({'action': 'upload', 'checkstatus': 1, 'filekey': filekey, 'format': 'json'},
+                             throttle=False).get('upload', {})
+        except Exception:
+            return None
+        return int(data['offset']) if 'offset' in data else None
+
+    def _chunk(self, spooled, filename, filekey, offset):
+        chunk = spooled.read(offset, self.chunk_size)
+        params = {
+            'action': 'upload',
+            'stash': 1,
+            'filename': filename,
+            'filesize': spooled.size,
+            'offset': offset,
+            'ignorewarnings': 1,
+            'format': 'json',
+        }
+        if filekey:
+            params['filekey'] = filekey
+        data = self.post(params, chunk=chunk, throttle=not filekey)['upload']
+        filekey = data.get('filekey', filekey)
+        if data.get('result') == 'Success' or offset + len(chunk) >= spooled.size:
+            return filekey, spooled.size
+        return filekey, int(data.get('offset', offset + len(chunk)))
+
+    def upload(self, spooled, filename, text, comment):
+        """
+        upload
+        @param spooled: File to upload.
+        @type spooled: Spooled
+        @param filename: File name on Commons, without "File:".
+        @type filename: str
+        @param text: Wikitext of the file page.
+        @type text: str
+        @param comment: Upload comment.
+        @type comment: str
+
+        :return: return the "upload" part of the final response
+        :rtype: the return type dict
+        """
+        filekey, offset = None, 0
+        stashed = self.stash.get(filename)
+        if stashed and stashed[0] == spooled.sha1:  # Same bytes as the upload that stopped
+            filekey = stashed[1]
+            offset = self._offset(filekey)
+            if offset is None:
+                filekey, offset = None, 0
+
+        failures = 0
+        while offset < spooled.size:
+            try:
+                filekey, offset = self._chunk(spooled, filename, filekey, offset)
+                failures = 0
+            except Exception as e:
+                self.stash[filename] = (spooled.sha1, filekey, offset)
+                failures += 1
+                if failures > self.retries:
+                    raise ChunkedUploadError("chunked upload of {} failed at byte {}: {}".format(
+                        filename, offset, e), filekey, offset) from e
+                time.sleep(self.backoff.delay(failures - 1))
+                server_offset = self._offset(filekey) if filekey else None
+                if server_offset is not None:
+                    offset = server_offset
+                elif getattr(e, 'other', None) and 'offset' in e.other:  # pywikibot APIError
+                    offset = int(e.other['offset'])
+            self.stash[filename] = (spooled.sha1, filekey, offset)
+
+        data = self.post({'action': 'upload', 'filename': filename, 'filekey': filekey, 'comment': comment,
+                          'text': text, 'ignorewarnings': 1, 'format': 'json'}, throttle=False)['upload']
+        if data.get('result') != 'Success':
+            raise ChunkedUploadError("upload of {} was not accepted: {}".format(filename, data), filekey, offset)
+        self.stash.pop(filename, None)
+        return data
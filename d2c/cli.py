@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Run a harvest from foto.digitalarkivet.no to Wikimedia Commons described in a job file.
+
+    d2c job.yaml
+    d2c job.json --processes 4 --report report.json
+    d2c job.yaml --dry-run review.jsonl
+
+The job file is YAML (needs PyYAML) or JSON:
+
+    queries:
+      - /fotoweb/archives/5001-Historiske-foto/;o=+?q=reinbeite*
+    rendition: tif
+    summary: Upload from Digitalarkivet
+    max_items: 500
+
+Progress goes to stderr, the report is printed to stdout as one JSON object.
+Exit code 0 when every image was handled, 1 when some failed, 2 for an invalid job
+file and 3 when the run stopped with an error.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from contextlib import redirect_stdout
+
+import pywikibot
+
+from .assetlist import AssetFields
+from .client import Client
+from .metrics import Metrics
+from .ratelimit import DefaultRates, RateLimits
+from .shard import Coordinator
+
+# Every key a job file can have, with its default. None means not used.
+JobDefaults = {
+    'queries': None,  # Search terms, required
+    'summary': None,  # Upload comment, required unless "dry_run" is set
+    'rendition': 'tif',  # tif, small_jpg or big_jpg
+    'max_items': None,  # Max images per query
+    'incremental': False,  # Only images new since the last run, needs "state"
+    'workers': None,  # Tasks in flight and threads per stage, one number for all or {'poll': 4, 'metadata': 4, ...}
+    'processes': 1,  # More than 1 runs "shard.Coordinator" worker processes, needs "job_dir"
+    'job_dir': None,  # Directory with the shared state of the worker processes
+    'rate_limits': None,  # {'fotoware': [start, min, max], 'commons': [...]} per second, split between processes
+    'metadata': 'xmp',  # xmp, assetlist or verify
+    'asset_fields': None,  # Field IDs per key, true for "assetlist.AssetFields", needed by "metadata: assetlist"
+    'upload_mode': 'url',  # url or chunked
+    'chunk_size': None,  # Bytes per chunk with "upload_mode: chunked"
+    'state': None,  # SQLite file with the progress of every image
+    'cache': None,  # SQLite file with the HTTP cache
+    'preflight': True,  # Skip files that exist on Commons before downloading, true or a cache file (one process)
+    'dedup': False,  # Skip near-duplicates by perceptual hash, true or a cache file
+    'dry_run': None,  # JSON lines file with the file name and wikitext of every image, nothing is uploaded
+    'metrics': None,  # File the metrics are written to while running
+    'progress': 30,  # Seconds between two progress lines
+}
+
+# Keys a job with more than one process can not use, the worker processes keep their state in "job_dir".
+OneProcessKeys = ('dry_run', 'dedup', 'max_items', 'incremental', 'state', 'workers')
+
+ExitOk = 0
+ExitFailures = 1
+ExitInvalidJob = 2
+ExitError = 3
+
+
+def load_job(path, **overrides):
+    """
+    load_job
+    @param path: YAML or JSON job file.
+    @type path: str
+    @param overrides: Job keys that replace the ones in the file, None values are ignored.
+    @type overrides: dict
+
+    :return: return the job with every key of "JobDefaults"
+    :rtype: the return type dict
+    """
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    if path.endswith('.json'):
+        job = json.loads(text)
+    else:
+        try:
+            import yaml
+        except ImportError:  # PyYAML is optional, JSON is valid YAML for simple jobs
+            yaml = None
+        if yaml is not None:
+            job = yaml.safe_load(text)
+        else:
+            try:
+                job = json.loads(text)
+            except ValueError:
+                raise ValueError(f"{path} is not JSON, install PyYAML to read YAML job files")
+    if isinstance(job, dict):
+        job.update({key: value for key, value in overrides.items() if value is not None})
+    return check_job(job)
+
+
+def check_job(job):
+    """
+    check_job
+    @param job: Job as read from a job file.
+    @type job: dict
+
+    :return: return the job with the defaults filled in
+    :rtype: the return type dict
+    """
+    if not isinstance(job, dict):
+        raise ValueError("The job file must hold a mapping")
+    unknown = sorted(set(job) - set(JobDefaults))
+    if unknown:
+        raise ValueError("Unknown job keys: {}".format(', '.join(unknown)))
+    single = [key for key in OneProcessKeys if job.get(key)]  # Set in the job file or on the command line
+    job = dict(JobDefaults, **job)
+
+    if isinstance(job['queries'], str):
+        job['queries'] = [job['queries']]
+    if not job['queries'] or not all(isinstance(query, str) for query in job['queries']):
+        raise ValueError("The job needs a list of queries")
+    if job['rendition'] not in Client.File_ending:
+        raise ValueError(f"Rendition, {job['rendition']}, is out of the scope")
+    if job['metadata'] not in Client.MetadataModes:
+        raise ValueError(f"Metadata mode, {job['metadata']}, is out of the scope")
+    if job['metadata'] == 'assetlist' and not job['asset_fields']:
+        raise ValueError("Metadata mode, assetlist, needs asset_fields, check the field IDs with verify first")
+    if job['asset_fields'] is True:
+        job['asset_fields'] = AssetFields
+    if job['upload_mode'] not in Client.UploadModes:
+        raise ValueError(f"Upload mode, {job['upload_mode']}, is out of the scope")
+    if not job['summary'] and not job['dry_run']:
+        raise ValueError("The job needs a summary")
+    if job['processes'] > 1 and not job['job_dir']:
+        raise ValueError("A job with more than one process needs a job_dir")
+    if job['processes'] > 1 and single:
+        raise ValueError("{} need a job with one process".format(', '.join(single)))
+    if job['processes'] > 1 and isinstance(job['preflight'], str):
+        raise ValueError("A preflight cache file needs a job with one process")
+    unknown = sorted(set(job['rate_limits'] or {}) - set(DefaultRates))
+    if unknown:
+        raise ValueError("Unknown rate limits: {}".format(', '.join(unknown)))
+    if job['incremental'] and not job['state']:
+        raise ValueError("An incremental job needs a state file")
+    if isinstance(job['workers'], int):
+        job['workers'] = {stage: job['workers'] for stage in ('poll', 'metadata', 'upload')}
+    return job
+
+
+def _rate_limits(job, share=1):
+    rates = dict(DefaultRates, **(job['rate_limits'] or {}))
+    return {name: tuple(rate / share for rate in limits) for name, limits in rates.items()}
+
+
+def _commons():
+    return pywikibot.Site("commons", "commons")
+
+
+class Progress:
+    """
+        Prints how many images are done every few seconds, from the counters of a Metrics.
+    """
+
+    def __init__(self, metrics, interval, stream=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.started = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def line(self):
+        counters = self.metrics.snapshot()['counters']
+        elapsed = time.monotonic() - self.started
+        uploaded = counters.get('uploaded', 0)
+        skipped = sum(counters.get(name, 0) for name in ('skipped_exists', 'skipped_duplicate', 'skipped_restricted'))
+        failed = sum(counters.get(name, 0) for name in ('failed_uploads', 'failed_metadata', 'failed_tasks'))
+        return "[d2c] {:.0f}s uploaded {}, skipped {}, failed {}, {:.2f} images/s".format(
+            elapsed, uploaded, skipped, failed, uploaded / elapsed if elapsed else 0.0)
+
+    def start(self):
+        def show():
+            while not self._stop.wait(self.interval):
+                print(self.line(), file=self.stream, flush=True)
+
+        if self.interval:
+            self._thread = threading.Thread(target=show, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        print(self.line(), file=self.stream, flush=True)
+
+
+def run_job(job):
+    """
+    run_job
+    @param job: Job from "load_job".
+    @type job: dict
+
+    :return: return the report of the run
+    :rtype: the return type dict
+    """
+    if job['processes'] > 1:
+        return _run_processes(job)
+
+    client = Client(metadata_mode=job['metadata'], asset_fields=job['asset_fields'], state=job['state'],
+                    cache=job['cache'],
+                    rate_limits=RateLimits(**_rate_limits(job)), metrics=Metrics(),
+                    upload_mode=job['upload_mode'], chunk_size=job['chunk_size'])
+    if job['metrics']:
+        client.metrics.start_dump(job['metrics'], job['progress'] or 60)
+    progress = Progress(client.metrics, job['progress'])
+    progress.start()
+    report = {'queries': len(job['queries'])}
+    try:
+        pages = []
+        for query in job['queries']:
+            pages.extend(client.iter_query(query, max_items=job['max_items'], incremental=job['incremental']))
+        client.pages = list(dict.fromkeys(pages))  # An image found by several queries is handled once
+        report['found'] = len(client.pages)
+
+        commons = None if job['dry_run'] else _commons()
+        if job['preflight'] and commons is not None and client.pages:  # Free, no download task is created
+            cache_file = job['preflight'] if isinstance(job['preflight'], str) else None
+            client.preflight(commons, job['rendition'], cache_file=cache_file)
+        if job['dedup'] and client.pages:
+            cache_file = job['dedup'] if isinstance(job['dedup'], str) else None
+            report['near_duplicates'] = len(client.dedup(commons, cache_file=cache_file))
+        report['to_upload'] = len(client.pages)
+
+        if job['dry_run']:
+            report['rendered'] = client.dry_run(job['dry_run'], job['rendition'])
+        elif client.pages:
+            report['pipeline'] = client.run(commons, job['rendition'], job['summary'], workers=job['workers'])
+    finally:
+        progress.stop()
+        client.metrics.stop_dump()
+        snapshot = client.metrics.snapshot()
+        report['seconds'] = snapshot['uptime']
+        report['counters'] = snapshot['counters']
+        report['rate_limits'] = client.rate_limits.stats()
+        if client.cache is not None:
+            report['cache'] = client.cache.stats()
+        if client.state is not None:
+            report['statuses'] = client.state.counts()
+    return report
+
+
+def _run_processes(job):
+    client_args = {'metadata_mode': job['metadata'], 'asset_fields': job['asset_fields'], 'cache': job['cache'],
+                   'upload_mode': job['upload_mode'], 'chunk_size': job['chunk_size'],
+                   'rate_limits': _rate_limits(job, job['processes'])}
+    coordinator = Coordinator(job['queries'], job['job_dir'], workers=job['processes'], client_args=client_args,
+                              progress_interval=job['progress'] or 30, preflight=bool(job['preflight']))
+    report = coordinator.run(job['rendition'], job['summary'])
+    report['queries'] = len(job['queries'])
+    report['counters'] = {'uploaded': report['statuses'].get('uploaded', 0),
+                          'failed_uploads': report['statuses'].get('failed', 0)}
+    return report
+
+
+def failures(report):
+    """
+    Amount of images that failed in a report of "run_job".
+    """
+    counters = report.get('counters', {})
+    failed = sum(counters.get(name, 0) for name in ('failed_uploads', 'failed_metadata', 'failed_tasks'))
+    stages = report.get('pipeline', {}).get('stages', {})
+    return failed + sum(stage['errors'] for stage in stages.values())
+
+
+def main(argv=None):
+    arg = argparse.ArgumentParser(prog='d2c', description=__doc__,
+                                  formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg.add_argument('job', help="YAML or JSON job file")
+    arg.add_argument('--workers', type=int, help="threads per pipeline stage, overrides the job file")
+    arg.add_argument('--processes', type=int, help="worker processes, overrides the job file")
+    arg.add_argument('--dry-run', metavar='FILE', help="write file names and wikitext to FILE instead of uploading")
+    arg.add_argument('--progress', type=float, help="seconds between two progress lines, 0 for none")
+    arg.add_argument('--report', metavar='FILE', help="also write the report to FILE")
+    args = arg.parse_args(argv)
+
+    report = {'job': args.job, 'started': time.time()}
+    try:
+        job = load_job(args.job, workers=args.workers, processes=args.processes, dry_run=args.dry_run,
+                       progress=args.progress)
+    except (OSError, ValueError, TypeError) as e:
+        print("d2c: invalid job: {}".format(e), file=sys.stderr)
+        report.update(error=repr(e), exit_code=ExitInvalidJob)
+    else:
+        try:
+            with redirect_stdout(sys.stderr):  # Keep stdout for the report
+                report.update(run_job(job))
+            report['exit_code'] = ExitFailures if failures(report) else ExitOk
+        except Exception as e:
+            print("d2c: {!r}".format(e), file=sys.stderr)
+            report.update(error=repr(e), exit_code=ExitError)
+
+    text = json.dumps(report)
+    print(text)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    return report['exit_code']
@@ -1,15 +1,26 @@
 #!/usr/bin/env python3
-from PIL import Image
-from PIL.TiffTags import TAGS
-import xml.etree.ElementTree as ET
-from io import BytesIO
-from pywikibot.specialbots import UploadRobot
-import dateutil.parser as parser
 import pywikibot
 import requests
 import re
 import json
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from .assetlist import asset_metadata, diff_metadata
+from .chunked import ChunkedUpload, site_post, spool
+from .commons import Preflight
+from .httpcache import CachingAdapter, HttpCache
+from .metrics import Metrics
+from .phash import HashIndex, dhash
+from .pipeline import Pipeline
+from .ratelimit import RateLimitedAdapter, RateLimits
+from .state import StateStore
+from .tasks import TaskPoller
+from .transport import DefaultTimeout, Transport
+from .wikitext import Licenses, Renderer, file_name
+from .xmp import fetch_xmp, parse_xmp
 
 name = "Digitalarkivet2Commons"
 api_version = 'v1'
@@ -32,6 +43,7 @@ class Client:
     """
 
     urlDA = 'https://foto.digitalarkivet.no'
+    urlThumbnails = 'https://upload.wikimedia.org'  # Thumbnails of Commons files, hashed by "dedup"
 
     headersPost = {
         'accept': 'application/json, text/javascript, */*; q=0.01',
@@ -53,15 +65,7 @@ class Client:
         'x-requested-with': 'XMLHttpRequest',
     }
 
-    Licenses = {
-        'falt i det fri': "{{PD-Norway50}}",
-        'cc0': "{{CC0}}",
-        'cc-0': "{{CC0}}",
-        'cc-by': "{{CC BY 4.0}}",
-        'cc by': "{{CC BY 4.0}}",
-        'cc-by-sa': "{{CC BY-SA 4.0}}",
-        'cc by-sa': "{{CC BY-SA 4.0}}",
-    }
+    Licenses = Licenses
 
     SizeOld = {
         "small_jpg": "/__renditions/Liten%20JPG",
@@ -75,6 +79,15 @@ class Client:
         "big_jpg": "/__renditions/7e57641d-85a1-47b3-9637-0f2db54b49ea",
     }
 
+    xmpBlockSize = 65536  # Bytes per Range request when reading the XMP packet
+    xmpMaxBytes = 8 * 1024 * 1024  # Max bytes read from one image before giving up on the XMP packet
+
+    MetadataModes = ("xmp", "assetlist", "verify")
+
+    UploadModes = ("url", "chunked")
+    uploadChunkSize = 4 * 1024 * 1024  # Bytes per chunk in the "chunked" upload mode
+    spoolMaxMemory = 32 * 1024 * 1024  # Bytes of a rendition kept in memory before it is spooled to disk
+
     File_ending = {
         "small_jpg": ".jpg",
         "tif": ".tif",
@@ -85,59 +98,302 @@ class Client:
             self,
             requests_timeout=None,
             requests_session=True,
-            user_agent=user_agent
+            user_agent=user_agent,
+            metadata_mode="xmp",
+            asset_fields=None,
+            state=None,
+            rate_limits=None,
+            metrics=None,
+            upload_mode="url",
+            chunk_size=None,
+            spool_ahead=1,
+            cache=None,
+            transport=None
     ):
+        """
+        __init__
+        @param metadata_mode: Where the metadata is read from. "xmp" downloads the XMP packet of each image,
+            "assetlist" uses the asset records from the query (no image bytes), "verify" uses the asset records
+            and prints the fields where they disagree with the XMP packet.
+        @type metadata_mode: str
+        @param asset_fields: FotoWare field IDs for each metadata key. Default "assetlist.AssetFields", which
+            is not yet checked against the archive, so "assetlist" mode needs the field IDs passed explicitly
+            (e.g. "assetlist.AssetFields" once "verify" found no mismatches).
+        @type asset_fields: dict
+        @param state: SQLite file (or StateStore) that keeps the progress of every image, so an interrupted
+            upload can be resumed. Default no state is kept.
+        @type state: str
+        @param rate_limits: Request rates for foto.digitalarkivet.no and Commons, shared by every thread.
+            Default "RateLimits()".
+        @type rate_limits: RateLimits
+        @param metrics: Timers and counters for every stage. Default "Metrics()".
+        @type metrics: Metrics
+        @param upload_mode: "url" lets Commons fetch each image from foto.digitalarkivet.no (needs the
+            upload_by_url right), "chunked" downloads each image to a temp file and uploads it in chunks.
+        @type upload_mode: str
+        @param chunk_size: Bytes per chunk in the "chunked" upload mode. Default "Client.uploadChunkSize".
+        @type chunk_size: int
+        @param spool_ahead: Images downloaded at the same time as the upload in the "chunked" upload mode.
+        @type spool_ahead: int
+        @param cache: SQLite file (or HttpCache) that keeps listing pages, asset records and the metadata read
+            from each image, revalidated with ETag/Last-Modified so unchanged ones are not downloaded again.
+            Default nothing is cached.
+        @type cache: str
+        @param requests_timeout: Seconds to connect and to wait for data, a number or a (connect, read) tuple.
+            Default "transport.DefaultTimeout".
+        @type requests_timeout: tuple
+        @param transport: Connection pools, retries and per-thread sessions. Default "Transport()" with
+            "requests_timeout", "user_agent" and "requests_session".
+        @type transport: Transport
+        """
+        if metadata_mode not in self.MetadataModes:
+            raise TypeError(
+                f"Metadata mode, {metadata_mode}, is out of the scope"
+            )
+        if metadata_mode == "assetlist" and asset_fields is None:
+            raise TypeError(
+                "Metadata mode, assetlist, needs asset_fields, check the field IDs with the verify mode first"
+            )
+        if upload_mode not in self.UploadModes:
+            raise TypeError(
+                f"Upload mode, {upload_mode}, is out of the scope"
+            )
         self.pages = []
+        self.assets = {}
         self.dont_upload = []
+        self.metadata_mode = metadata_mode
+        self.asset_fields = asset_fields
+        self.poller = None
+        self.query_validators = {}
+        self.commons_check = None
+        self.renderer = Renderer(self.Licenses)
+        self.hash_index = None
+        self.upload_mode = upload_mode
+        self.chunk_size = chunk_size or self.uploadChunkSize
+        self._spool_pool = ThreadPoolExecutor(spool_ahead) if upload_mode == 'chunked' else None
+        self._spools = {}
+        self._uploaders = {}
+        self._checked = {}  # download link -> (file name, wikitext) of images checked by "prepare_upload"
+        self.state = StateStore(state) if isinstance(state, str) else state
+        self.cache = HttpCache(cache) if isinstance(cache, str) else cache
         if isinstance(requests_session, requests.Session):
-            self._S = requests_session
-        else:
-            if requests_session:  # Build a new session.
-                self._S = requests.Session()
-            else:  # todo: Use the Requests API module as a "session".
-                raise NotImplementedError()
+            session = requests_session
+        elif requests_session:  # One new session per thread.
+            session = None
+        else:  # todo: Use the Requests API module as a "session".
+            raise NotImplementedError()
+        self.transport = transport or Transport(timeout=requests_timeout or DefaultTimeout, user_agent=user_agent,
+                                                session=session)
+        self.rate_limits = rate_limits or RateLimits()
+        self.metrics = metrics or Metrics()
+        self._mount()
+
+    @property
+    def _S(self):
+        return self.transport.session
+
+    def _mount(self):
+        self.rate_limits.hosts.setdefault(urlparse(self.urlDA).hostname, self.rate_limits.fotoware)
+        adapter = self.transport.adapter(RateLimitedAdapter, limits=self.rate_limits)
+        if self.cache is not None:
+            adapter = CachingAdapter(self.cache, adapter, self.metrics)
+        self.transport.mount(self.urlDA, adapter)
+        self.transport.mount(self.urlThumbnails, self.transport.adapter(RateLimitedAdapter, limits=self.rate_limits))
 
     def __dir__(self):
         return self.__dict__.keys()
 
-    def query(self, query, limit=2000):
+    def _record(self, href, status, **kwargs):
+        if self.state is not None:
+            self.state.set_status(href, status, **kwargs)
+
+    def resume(self):
+        """
+        resume
+
+        :return: return the image pages from "self.state" that are not done yet, also stored in "self.pages"
+        :rtype: the return type list
+        """
+        if self.state is None:
+            raise TypeError(
+                f"There is no state to resume from."
+            )
+        self.pages = self.state.pending()
+        return self.pages
+
+    def query(self, query, limit=2000, max_items=None, prefetch=4, incremental=False):
         """
         query
         @param query: Search term used for finding images.
         @type query: str
         @param limit: Max amount of pages to check for images.
         @type limit: int
+        @param max_items: Max amount of images to find. Default no limit.
+        @type max_items: int
+        @param prefetch: Amount of pages fetched at the same time when the page links are predictable.
+        @type prefetch: int
+        @param incremental: Only find images that are new since the last run of the query, see "iter_query".
+        @type incremental: bool
 
         :return: return True if success
         :rtype: the return type bool
         """
-        is_last = False
-        pagenr = 0
-        list_files = []
-        url = self.urlDA + query
-
-        while True or limit <= pagenr:
+        self.pages = list(self.iter_query(query, limit, max_items, prefetch, incremental))
+        return True
 
+    def _query_response(self, url, headers=None):
+        with self.metrics.time('query_page'):
             response = self._S.get(url,
-                                   headers={'Accept': 'application/vnd.fotoware.assetlist+json, */*; '
-                                                      'q=0.01'})
-            data = response.json()
+                                   headers=dict({'Accept': 'application/vnd.fotoware.assetlist+json, */*; '
+                                                           'q=0.01'}, **(headers or {})))
+        self.metrics.incr('bytes_fotoware', len(response.content))
+        return response
 
-            for ref in data["data"]:
-                if ref['href'].endswith(".tif.info"):
-                    list_files.append(ref['href'])
-            pagenr += 1
+    def _query_page(self, url):
+        return self._query_response(url).json()
 
-            if is_last:
-                break
+    def _page_urls(self, data):
+        """
+        Links to the remaining pages, if "next" and "last" only differ in the page number.
 
+        :return: return a list of urls, or None if the paging links are not predictable
+        :rtype: the return type list
+        """
+        next_page = re.search(r'([;&?]p=)(\d+)', data['paging']['next'])
+        last_page = re.search(r'([;&?]p=)(\d+)', data['paging']['last'])
+        if not next_page or not last_page:
+            return None
+        template = data['paging']['next']
+        if template[:next_page.start()] + template[next_page.end():] != \
+                data['paging']['last'][:last_page.start()] + data['paging']['last'][last_page.end():]:
+            return None
+        return [self.urlDA + template[:next_page.start(2)] + str(nr) + template[next_page.end(2):]
+                for nr in range(int(next_page[2]), int(last_page[2]) + 1)]
+
+    def _iter_pages(self, query, limit, prefetch, conditional=None):
+        url = self.urlDA + query
+        response = self._query_response(url, conditional)
+        self.query_validators = {'etag': response.headers.get('ETag'),
+                                 'last_modified': response.headers.get('Last-Modified')}
+        if response.status_code == 304:  # Nothing changed since the last run
+            return
+        data = response.json()
+        yield data
+
+        urls = self._page_urls(data) if prefetch > 1 and data['paging']['next'] else None
+        if urls is not None:  # Fetch the next pages in parallel, but yield them in order
+            urls = urls[:max(limit - 1, 0)]
+            with ThreadPoolExecutor(max_workers=prefetch) as pool:
+                pending = deque()
+                try:
+                    for page_url in urls:
+                        pending.append(pool.submit(self._query_page, page_url))
+                        if len(pending) >= prefetch:
+                            yield pending.popleft().result()
+                    while pending:
+                        yield pending.popleft().result()
+                finally:
+                    for future in pending:
+                        future.cancel()
+            return
+
+        pagenr = 1
+        while pagenr < limit:
             if data['paging']['next'] == "":
+                if not data['paging']['last'] or self.urlDA + data['paging']['last'] == url:
+                    break
                 url = self.urlDA + data['paging']['last']
-                is_last = True
-            else:
-                url = self.urlDA + data['paging']['next']
-            # break
-        self.pages = list(dict.fromkeys(list_files))  # remove duplicates
+                yield self._query_page(url)
+                break
+            url = self.urlDA + data['paging']['next']
+            data = self._query_page(url)
+            yield data
+            pagenr += 1
+
+    def iter_query(self, query, limit=2000, max_items=None, prefetch=4, incremental=False, stop_after=1):
+        """
+        iter_query
+        @param query: Search term used for finding images.
+        @type query: str
+        @param limit: Max amount of pages to check for images.
+        @type limit: int
+        @param max_items: Max amount of images to find. Default no limit.
+        @type max_items: int
+        @param prefetch: Amount of pages fetched at the same time when the page links are predictable.
+        @type prefetch: int
+        @param incremental: Only find images that are new since the last run of the query. Needs "self.state"
+            and a query sorted with the newest images first. The first page is requested with the ETag and
+            Last-Modified of the last run, and paging stops at the first page with only known images. Images
+            of the query stored by an earlier run that are not done yet are found as well.
+        @type incremental: bool
+        @param stop_after: Amount of pages with only known images before an incremental query stops.
+        @type stop_after: int
+
+        :return: yields the image pages without duplicates, as soon as each page of the result has arrived
+        :rtype: the return type generator
+        """
+        watermark = None
+        conditional = None
+        if incremental:
+            if self.state is None:
+                raise TypeError(
+                    f"Incremental query needs a state."
+                )
+            prefetch = 1  # Pages after the known images would be wasted requests
+            watermark = self.state.watermark(query)
+            if watermark:
+                conditional = {}
+                if watermark['etag']:
+                    conditional['If-None-Match'] = watermark['etag']
+                if watermark['last_modified']:
+                    conditional['If-Modified-Since'] = watermark['last_modified']
+        since = (watermark['modified'] or '') if watermark else ''
+        newest = since
+
+        seen = set()
+        known_pages = 0
+        complete = True
+        for data in self._iter_pages(query, limit, prefetch, conditional):
+            refs = [ref for ref in data["data"] if ref['href'].endswith(".tif.info") and ref['href'] not in seen]
+            known = self.state.known(ref['href'] for ref in refs) if incremental else set()
+
+            new = []
+            changed = False
+            for ref in refs:
+                modified = ref.get('modified') or ''
+                newest = max(newest, modified)
+                if ref['href'] not in known or modified > since:
+                    changed = True
+                seen.add(ref['href'])
+                self.assets[ref['href']] = ref
+                if not incremental or ref['href'] not in known or not self.state.is_done(ref['href']):
+                    new.append(ref['href'])
+                if max_items is not None and len(seen) >= max_items:
+                    complete = False
+                    break
+
+            if self.state is not None:
+                self.state.add_many(new, query)
+            yield from new
+            if not complete:
+                return
+
+            known_pages = 0 if changed else known_pages + 1
+            if incremental and known_pages >= stop_after:
+                break
+
+        if incremental:
+            # Images stored by an earlier run that stopped before they were done, e.g. behind a 304
+            left = [href for href in self.state.pending(query=query) if href not in seen]
+            if max_items is not None:
+                left = left[:max(max_items - len(seen), 0)]
+            seen.update(left)
+            yield from left
+
+            old = watermark or {}
+            self.state.set_watermark(query, self.query_validators['etag'] or old.get('etag'),
+                                     self.query_validators['last_modified'] or old.get('last_modified'),
+                                     newest or None)
 
     def _post(self, page_list, size):
         """
@@ -153,8 +409,9 @@ class Client:
         data = {"request": {"assets": []}}  # Takes MAX 4 images in one request!
         for urlimg in page_list:
             data['request']['assets'].append({'href': urlimg + size})
-        response = self._S.post(self.urlDA + '/fotoweb/me/background-tasks/', headers=self.headersPost,
-                                data=json.dumps(data))
+        with self.metrics.time('task_create'):
+            response = self._S.post(self.urlDA + '/fotoweb/me/background-tasks/', headers=self.headersPost,
+                                    data=json.dumps(data))
         rdata = response.json()
         if "message" in rdata:
             raise TypeError(rdata["message"])
@@ -164,44 +421,46 @@ class Client:
 
         return False
 
-    def _get(self, background_task):
+    def _status(self, background_task):
         """
         API GET
         @param background_task: part of the url for access to image
         @type background_task: str
 
-        :return: return the JSON object
+        :return: return the JSON object with the current status of the task
         :rtype: the return type dict
         """
-        not_finished = True
-        data = {}
-
-        while not_finished:
+        with self.metrics.time('task_poll'):
             response = self._S.get(self.urlDA + background_task, headers=self.headersGet)
-            data = response.json()
-            if data and data['job']['status'] == 'done':
-                not_finished = False
+        return response.json()
 
-        return data
-
-    def get_metadata(self, src2, href2, file_ending):
+    def iter_files(self, file_ending="tif", pages=None, in_flight=4, record=True):
         """
-        get_metadata
-        @param src2: Images page file on foto.digitalarkivet.no.
-        @type src2: str
-        @param href2: Image download link on foto.digitalarkivet.no.
-        @type href2: str
-        @param file_ending: Type of image file. Valid options: tif, small_jpg or big_jpg.
+        iter_files
+        @param file_ending: Size for the image. Most be in "self.Size". Default "tif".
         @type file_ending: str
+        @param pages: Image pages to create download tasks for. Default "self.pages".
+        @type pages: iterable
+        @param in_flight: Max amount of download tasks waiting on the server at the same time.
+        @type in_flight: int
+        @param record: Record the files as "downloaded" in "self.state", False for files that are not uploaded.
+        @type record: bool
+
+        :return: yields the files of each download task as soon as it is done
+        :rtype: the return type generator
+        """
+        self.poller = TaskPoller(self, self.Size[file_ending], in_flight=in_flight, record=record)
+        return self.poller.run(self.pages if pages is None else pages)
 
-        :return: returns a JSON object with metadata
-        :rtype: the return type dict
+    def _base_metadata(self, src2, href2):
+        """
+        Metadata dict with every key empty except the links to the image.
         """
         # CustomField1 = Originalformat, CustomField17 = Institusjon, CustomField18 = Arkivnavn, IF4b_kommentar =
         # Tilleggsinformasjon, IF22a_aksesjonsnummer = Arkivreferanse, UserDefined223 = URN kataloginfo,
         # UserDefined233 = Restriksjon, digitalarkivetName = Unique name from digitalarkivet
 
-        commons_data = {
+        return {
             'title': '',
             'rights': [],
             'desc': '',
@@ -222,93 +481,301 @@ class Client:
             'source': self.urlDA + src2,
             'href': self.urlDA + href2
         }
-        response = self._S.get(commons_data['href'])
-        meta_dict2 = ""
-        if file_ending == "tif":
-            with Image.open(BytesIO(response.content)) as img:
-                meta_dict = {TAGS[key]: img.tag[key] for key in img.tag.keys()}
-                # print(meta_dict['XMP']) #DEBUG
-                meta_dict2 = ET.fromstring(meta_dict['XMP'])
-
-        elif file_ending == "small_jpg" or file_ending == "big_jpg":
-            with Image.open(BytesIO(response.content)) as im:
-                for segment, content in im.applist:
-                    if segment == 'APP1' and content.startswith(b'http://ns.adobe.com/xap/1.0/'):
-                        # print(content[29::]) #DEBUG
-                        meta_dict2 = ET.fromstring(content[29::])
-                        break
-        else:
-            raise TypeError(
-                f"File type, {file_ending}, is out of the scope"
-            )
 
-        tree = meta_dict2
+    def get_asset(self, src2):
+        """
+        get_asset
+        @param src2: Images page file on foto.digitalarkivet.no.
+        @type src2: str
+
+        :return: returns the asset record, from the query if it was listed there
+        :rtype: the return type dict
+        """
+        if src2 not in self.assets:
+            response = self._S.get(self.urlDA + src2,
+                                   headers={'Accept': 'application/vnd.fotoware.asset+json, */*; q=0.01'})
+            self.assets[src2] = response.json()
+        return self.assets[src2]
+
+    def get_asset_metadata(self, src2, href2):
+        """
+        get_asset_metadata
+        @param src2: Images page file on foto.digitalarkivet.no.
+        @type src2: str
+        @param href2: Image download link on foto.digitalarkivet.no.
+        @type href2: str
+
+        :return: returns a JSON object with metadata, same keys as "get_metadata"
+        :rtype: the return type dict
+        """
+        return asset_metadata(self.get_asset(src2), self._base_metadata(src2, href2), self.asset_fields)
+
+    def check_metadata(self, src2, href2, file_ending):
+        """
+        check_metadata
+        @param src2: Images page file on foto.digitalarkivet.no.
+        @type src2: str
+        @param href2: Image download link on foto.digitalarkivet.no.
+        @type href2: str
+        @param file_ending: Type of image file. Valid options: tif, small_jpg or big_jpg.
+        @type file_ending: str
+
+        :return: returns the asset list metadata and the fields where it disagrees with the XMP packet,
+            mapped to (asset list value, XMP value)
+        :rtype: the return type tuple
+        """
+        meta = self.get_asset_metadata(src2, href2)
+        return meta, diff_metadata(meta, self.get_metadata(src2, href2, file_ending))
+
+    def collect_metadata(self, src2, href2, file_ending):
+        """
+        collect_metadata
+        @param src2: Images page file on foto.digitalarkivet.no.
+        @type src2: str
+        @param href2: Image download link on foto.digitalarkivet.no.
+        @type href2: str
+        @param file_ending: Type of image file. Valid options: tif, small_jpg or big_jpg.
+        @type file_ending: str
 
-        nmspdict = {'x': 'adobe:ns:meta/',
-                    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
-                    'dc': 'http://purl.org/dc/elements/1.1/',
-                    'fwc': 'http://ns.fotoware.com/iptcxmp-custom/1.0/',
-                    'fwu': 'http://ns.fotoware.com/iptcxmp-user/1.0/',
-                    'photoshop': "http://ns.adobe.com/photoshop/1.0/",
-                    'xmpRights': "http://ns.adobe.com/xap/1.0/rights/"}
+        :return: returns a JSON object with metadata from the source chosen by "self.metadata_mode"
+        :rtype: the return type dict
+        """
+        if self.state is not None:  # Metadata from an earlier run
+            row = self.state.get(src2)
+            if row and row['commons_data'] and row['commons_data']['source'] == self.urlDA + src2:
+                meta = row['commons_data']
+                meta['href'] = self.urlDA + href2  # Download links are made per task
+                return meta
+
+        cache_key = validator = None
+        if self.cache is not None and self.metadata_mode != "assetlist":  # Metadata read from the image before
+            cache_key = '{}:{}:{}'.format(self.metadata_mode, file_ending, self.urlDA + src2)
+            validator = self.get_asset(src2).get('modified')
+            meta = self.cache.get_value(cache_key, validator)
+            if meta is not None:
+                self.metrics.incr('metadata_cache_hits')
+                meta['href'] = self.urlDA + href2  # Download links are made per task
+                self._record(src2, 'described', commons_data=meta)
+                return meta
+            self.metrics.incr('metadata_cache_misses')
 
-        tags = tree.findall("rdf:RDF/rdf:Description/dc:subject/rdf:Bag/rdf:li",  # Keyword
-                            namespaces=nmspdict)
+        try:
+            if self.metadata_mode == "xmp":
+                meta = self.get_metadata(src2, href2, file_ending)
+            elif self.metadata_mode == "verify":
+                meta, diff = self.check_metadata(src2, href2, file_ending)
+                for key, (asset_val, xmp_val) in sorted(diff.items()):
+                    print("metadata mismatch {} {}: {!r} != {!r}".format(src2, key, asset_val, xmp_val))
+            else:
+                meta = self.get_asset_metadata(src2, href2)
+        except Exception as e:
+            self.metrics.incr('failed_metadata')
+            self._record(src2, 'failed', error=repr(e))
+            raise
 
-        tags2 = tree.findall("rdf:RDF/rdf:Description/dc:title/rdf:Alt/rdf:li",  # Title
-                             namespaces=nmspdict)
+        if cache_key is not None:
+            self.cache.put_value(cache_key, validator, meta)
 
-        tags3 = tree.findall("rdf:RDF/rdf:Description/dc:creator/rdf:Seq/rdf:li",  # Creator
-                             namespaces=nmspdict)
+        self._record(src2, 'described', commons_data=meta)
+        return meta
 
-        gjenbruk = tree.findall("rdf:RDF/rdf:Description/xmpRights:UsageTerms/rdf:Alt/rdf:li",  # Usage terms
-                                namespaces=nmspdict)
+    def get_metadata(self, src2, href2, file_ending):
+        """
+        get_metadata
+        @param src2: Images page file on foto.digitalarkivet.no.
+        @type src2: str
+        @param href2: Image download link on foto.digitalarkivet.no.
+        @type href2: str
+        @param file_ending: Type of image file. Valid options: tif, small_jpg or big_jpg.
+        @type file_ending: str
 
-        rettigheter = tree.findall("rdf:RDF/rdf:Description/dc:rights/rdf:Alt/rdf:li",  # rights
-                                   namespaces=nmspdict)
+        :return: returns a JSON object with metadata
+        :rtype: the return type dict
+        """
+        commons_data = self._base_metadata(src2, href2)
+        with self.metrics.time('metadata_download'):
+            packet = fetch_xmp(self._S, commons_data['href'], file_ending, self.xmpBlockSize, self.xmpMaxBytes,
+                               self.metrics)
+        if not packet:
+            raise ValueError(
+                f"No XMP metadata found in {commons_data['href']}"
+            )
 
-        desc = tree.findall("rdf:RDF/rdf:Description/dc:description/rdf:Alt/rdf:li",  # Description
-                            namespaces=nmspdict)
+        with self.metrics.time('metadata_parse'):
+            return parse_xmp(packet, commons_data)
 
-        jpg_desc = tree.findall("rdf:RDF/rdf:Description",  # Description for JPGs
-                                namespaces=nmspdict)
+    def file_name(self, metadata, file_ending):
+        """
+        file_name
+        @param metadata: All of the choosen metadata from the image.
+        @type metadata: dict
+        @param file_ending: File extension including the dot, e.g. ".tif".
+        @type file_ending: str
 
-        blacklist_jpg = ['title', 'subject', 'creator', 'description']
-        for val in jpg_desc:  # for JPG files
-            for keys2 in list(val):
-                keyRegZ = re.sub(r'{.*}', '', str(keys2.tag))
-                if keyRegZ not in blacklist_jpg and keyRegZ in commons_data:
-                    if keys2.text != '\n' and keys2.tag:
-                        commons_data[keyRegZ] = keys2.text
+        :return: return the file name used on Commons, without the "File:" prefix
+        :rtype: the return type str
+        """
+        return file_name(metadata, file_ending)
 
-        for descAttri in tree.findall('rdf:RDF/rdf:Description', namespaces=nmspdict):  # For JPG and TIF files (
-            # description)
-            zipped = zip(descAttri.attrib.keys(), descAttri.attrib.values())
-            for keyZ, valZ in zipped:
-                keyRegZ = re.sub(r'{.*}', '', keyZ)
-                if keyRegZ in commons_data:
-                    if valZ != '\n':
-                        commons_data[keyRegZ] = valZ
+    def preflight(self, commons, file_ending="tif", pages=None, sha1s=None, cache_file=None):
+        """
+        preflight
+        @param commons: site that is used for upload
+        @type commons: pywikibot.site.APISite
+        @param file_ending: Size for the image. Most be in "self.Size". Default "tif".
+        @type file_ending: str
+        @param pages: Image pages to check. Default "self.pages", which is updated.
+        @type pages: list
+        @param sha1s: SHA-1 of the source file for each image page, if known.
+        @type sha1s: dict
+        @param cache_file: JSON file the answers from Commons are cached in.
+        @type cache_file: str
 
-        for nOrd in tags:
-            commons_data['keywords'].append(nOrd.text)
+        Skipped images are recorded as "exists" in "self.state".
 
-        if tags2 and tags2[0].text:
-            commons_data['title'] = tags2[0].text
+        :return: return the image pages that remain to be uploaded
+        :rtype: the return type list
+        """
+        if file_ending not in self.File_ending:
+            raise TypeError(
+                f"File type, {file_ending}, is out of the scope"
+            )
+        if self.commons_check is None or self.commons_check.site != commons:
+            self.commons_check = Preflight(commons, cache_file)
+        check = self.commons_check
+        todo = self.pages if pages is None else pages
+
+        names = {}
+        for src in todo:  # The asset record gives the file name without creating a download task
+            meta = self.get_asset_metadata(src, src[:-len('.info')] if src.endswith('.info') else src)
+            names[src] = self.file_name(meta, self.File_ending[file_ending])
+        existing = check.existing(names.values())
+        duplicates = check.duplicates(sha1s.values()) if sha1s else {}
+
+        remaining = []
+        for src in todo:
+            if names[src] in existing:
+                print("image exist! {}".format(names[src]))
+            elif sha1s and src in sha1s and sha1s[src].lower() in duplicates:
+                print("image exist! {} as {}".format(names[src], ', '.join(duplicates[sha1s[src].lower()])))
+            else:
+                remaining.append(src)
+                continue
+            self._record(src, 'exists', title=names[src])
+        check.save()
 
-        for creatorname in tags3:
-            commons_data['creator'].append(creatorname.text)
+        if pages is None:
+            self.pages = remaining
+        return remaining
 
-        for rett in rettigheter:
-            commons_data['rights'].append(rett.text)
+    def dedup(self, commons=None, pages=None, index=None, cache_file=None, skip=True, in_flight=4):
+        """
+        dedup
+        @param commons: site that is used for upload. The hashes of the files in "phash.Category" are added
+            to the index first. Default only images in "pages" are compared with each other.
+        @type commons: pywikibot.site.APISite
+        @param pages: Image pages to check. Default "self.pages", which is updated when "skip" is True.
+        @type pages: list
+        @param index: Hashes to compare with. Default "HashIndex(cache_file)", kept in "self.hash_index".
+        @type index: HashIndex
+        @param cache_file: JSON file the hashes of Commons files are cached in.
+        @type cache_file: str
+        @param skip: Remove near-duplicates from the pages to upload, else only report them.
+        @type skip: bool
+        @param in_flight: Max amount of download tasks waiting on the server at the same time.
+        @type in_flight: int
+
+        Each image is compared by the perceptual hash of its "small_jpg" rendition, before the TIF is
+        downloaded. An image that looks like a file on Commons, or like an image earlier in "pages", is a
+        near-duplicate.
+
+        :return: return the near-duplicates, each image page mapped to [(distance, file name or image page)]
+        :rtype: the return type dict
+        """
+        if index is None:
+            index = self.hash_index = self.hash_index or HashIndex(cache_file)
+        if commons is not None:
+            with self.metrics.time('phash_index'):
+                index.add_category(commons, transport=self.transport)
+            index.save()
+        todo = self.pages if pages is None else pages
+        if self.state is not None:  # Images that are done need no hash
+            todo = self.state.pending(todo)
+
+        duplicates = {}
+        for img in self.iter_files("small_jpg", todo, in_flight, record=False):
+            with self.metrics.time('phash'):
+                response = self._S.get(self.urlDA + img['href'])
+                response.raise_for_status()
+                value = dhash(response.content)
+            near = index.find(value)
+            if near:
+                duplicates[img['src']] = near
+                self.metrics.incr('near_duplicates')
+                print("image looks like {}: {}".format(', '.join(name for _, name in near), img['src']))
+                if skip:
+                    # Only a match on Commons is stored, an image like one earlier in this run is checked again
+                    on_commons = [name for _, name in near if name in index.hashes]
+                    if on_commons:
+                        self._record(img['src'], 'exists', title=on_commons[0])
+                    continue
+            index.add(img['src'], value, commons=False)
+
+        if skip:
+            remaining = [src for src in todo if src not in duplicates]
+            if pages is None:
+                self.pages = remaining
+        return duplicates
+
+    def dry_run(self, path, file_ending="tif", pages=None):
+        """
+        dry_run
+        @param path: JSON lines file written with the source, Commons file name and wikitext of every image.
+        @type path: str
+        @param file_ending: Size for the image. Most be in "self.Size". Default "tif".
+        @type file_ending: str
+        @param pages: Image pages to render. Default "self.pages".
+        @type pages: list
 
-        for gjen in gjenbruk:
-            commons_data['rights'].append(gjen.text)
+        Nothing is downloaded or sent to Commons. The metadata comes from the same place the upload reads it:
+        "self.state" when an earlier run stored it, then the metadata cache, then the asset records of the query.
+        With a "metadata_mode" other than "assetlist" the asset records only approximate the XMP packet the
+        upload would read, so every line tells its "metadata_source" and the approximated ones are counted.
 
-        if desc and desc[0].text:
-            commons_data['desc'] = desc[0].text
+        :return: return the amount of images written
+        :rtype: the return type int
+        """
+        if file_ending not in self.File_ending:
+            raise TypeError(
+                f"File type, {file_ending}, is out of the scope"
+            )
 
-        return commons_data
+        approximated = []
+
+        def metas():
+            for page in self.pages if pages is None else pages:
+                row = self.state.get(page) if self.state is not None else None
+                if row and row['commons_data'] and row['commons_data']['source'] == self.urlDA + page:
+                    yield dict(row['commons_data'], metadata_source='state')
+                    continue
+                if self.cache is not None and self.metadata_mode != "assetlist":
+                    cache_key = '{}:{}:{}'.format(self.metadata_mode, file_ending, self.urlDA + page)
+                    meta = self.cache.get_value(cache_key, self.get_asset(page).get('modified'))
+                    if meta is not None:
+                        yield dict(meta, metadata_source='cache')
+                        continue
+                if self.metadata_mode == "assetlist":
+                    yield dict(self.get_asset_metadata(page, page[:-len('.info')]), metadata_source='assetlist')
+                else:  # The XMP packet is only read when downloading
+                    approximated.append(page)
+                    yield dict(self.get_asset_metadata(page, page[:-len('.info')]),
+                               metadata_source='assetlist (approximation)')
+
+        written = self.renderer.dry_run(metas(), path, self.File_ending[file_ending])
+        if approximated:
+            print("{} of {} images rendered from their asset records, an approximation of the {} metadata the "
+                  "upload uses".format(len(approximated), written, self.metadata_mode))
+        return written
 
     def media_upload(self, metadata, commons, file_ending=".tif", user_summary=""):
         """
@@ -321,128 +788,219 @@ class Client:
         @type file_ending: str
         @param user_summary: Summary for the image upload
         @type user_summary: str
-        """
-        file_ending_local = file_ending.lower()
-        if file_ending.lower() == 'small_jpg' or file_ending.lower() == 'big_jpg':
-            file_ending_local = '.jpg'
 
-        if metadata['Country'] and metadata['Country'].lower() == "ukjent land":
-            metadata['Country'] = ''
+        :return: return the file name on Commons if uploaded, else 0
+        :rtype: the return type str
+        """
+        src = metadata['source'][len(self.urlDA):]
+        if metadata['href'] in self._checked:  # Checked before the image was downloaded
+            checked = self._checked.pop(metadata['href'])
+        else:
+            checked = self._check_upload(metadata, commons, file_ending)
+        if checked is None:
+            return 0
+        use_filename, description = checked
 
-        countryTrans = {'norge': 'Norway', 'sverige': 'Sweden', 'finland': 'Finland', 'danmark': 'Denmark', 'ukjent '
-                                                                                                            'land': ''}
+        spooled = None
         try:
-            dateFix = parser.parse(metadata['DateCreated']).isoformat()[0:10] if len(metadata['DateCreated']) > 4 else \
-                metadata['DateCreated']
-        except:
-            dateFix = metadata['DateCreated']
+            if self.upload_mode == 'chunked':
+                spooled = self._spooled(metadata['href'])
+                duplicate = self.commons_check.duplicates([spooled.sha1]) if self.commons_check else {}
+                if duplicate:  # Same bytes under another name
+                    print("image exist as {}!".format(duplicate[spooled.sha1][0]))
+                    self.metrics.incr('skipped_duplicate')
+                    self._record(src, 'exists', title=duplicate[spooled.sha1][0])
+                    return 0
+
+            self.rate_limits.commons.acquire()
+            with self.metrics.time('commons_upload'):
+                if spooled is not None:
+                    self._commons_upload_file(commons, spooled, description, use_filename, user_summary)
+                else:
+                    self._commons_upload(commons, metadata['href'], description, use_filename, user_summary)
+        except Exception as e:
+            self.metrics.incr('failed_uploads')
+            self.rate_limits.commons_error(e)
+            self._record(src, 'failed', title=use_filename, error=repr(e))
+            raise
+        finally:
+            if spooled is not None:
+                spooled.close()
+        self.rate_limits.commons.success()
+        self.metrics.incr('uploaded')
+        if self.commons_check:
+            self.commons_check.uploaded(use_filename)
+        self._record(src, 'uploaded', title=use_filename)
+
+        # print(description)
+        # print(use_filename)
+        return use_filename
 
-        unknownValues = ['Country', 'State', 'City']
+    def _check_upload(self, metadata, commons, file_ending=".tif"):
+        """
+        _check_upload
+        @param metadata: All of the choosen metadata from the image.
+        @type metadata: dict
+        @param commons: site that is used for upload
+        @type commons: pywikibot.site.APISite
+        @param file_ending: Type of image file. Valid options: .tif or .jpg
+        @type file_ending: str
 
-        for val in unknownValues:
-            metadata[val] = '' if metadata[val] == '' or metadata[val].lower() == 'ukjent' else metadata[val]
+        Restricted images, file names claimed by another image and files on Commons are recorded and skipped.
 
-        if 'Ukjent' not in metadata['creator']:
-            for i, name_creator in enumerate(metadata['creator']):
-                splitname = name_creator.split(',')
-                if splitname and (splitname[1] + ' ' + splitname[0]).lower() == " jens holmboe":
-                    metadata['creator'][i] = "{{Creator:Jens Holmboe (botanist)}}"
-                else:
-                    metadata['creator'][i] = '{} {}'.format(splitname[1], splitname[0])
-
-        if len(metadata['keywords']) > 1:
-            for seq in range(1, len(metadata['keywords'])):
-                metadata['keywords'][seq] = metadata['keywords'][seq].lower()
-
-        depicted_place = ', '.join(filter(None, [metadata['City'], metadata['State'], metadata['Country']]))
-
-        use_filename = '{} ({}){}'.format(metadata['title'], metadata['digitalarkivetName'], file_ending_local).strip()
-        if metadata['title'] == "":
-            use_filename = '{}{}'.format(metadata['digitalarkivetName'], file_ending_local).strip()            
-        
-        url = [metadata['href']]
-        summary = user_summary
-        keep_filename = False
-        always = True
-        filename_prefix = None
-        verify_description = True
-        ignore_warning = True
-        aborts = set()
-        chunk_size = 0
-        recursive = False
-        description_file = None
-        description = '''=={{int:filedesc}}==
-{{Photograph
-|description        = {{nb|1= Bildet er hentet fra Arkivverket.<br/>\n'''
-        description += metadata['desc'] + '}}\n'
-        description += '|title              = {}\n'.format(metadata['title'])
-        description += '|depicted place     = {{nb | 1 = ' + depicted_place + ' }}\n' if depicted_place else '|depicted place     = \n'
-        description += '|date               = {{ISOdate|' + dateFix + '}}\n' if metadata['DateCreated'] and dateFix and \
-                                                                                metadata[
-                                                                                    'DateCreated'] != '' else '|date               = \n'
-        description += '|institution        = {}\n'.format(metadata['CustomField17'])
-        description += '|department         = {}\n'.format('{{institution:Arkivverket}}')
-        description += '|accession number   = {}\n'.format(metadata['IF22a_aksesjonsnummer'])
-        description += '|notes              = {{nb | 1 = ' + '{}'.format(', '.join(
-            filter(None, metadata['keywords']))) + ' }}\n' if "keywords" in metadata else '|notes              = \n'
-        description += '|object history     = {{nb | 1 = ' + metadata[
-            'CustomField18'] + ' }}\n' if 'CustomField18' in metadata else '|object history     = '
-        description += '|source             = [{0} foto.digitalarkivet.no]\n'.format(metadata['source'])
-
-        description += '|photographer       = {{creator:unknown}}' if metadata['creator'] and 'Ukjent' in metadata[
-            'creator'] else '|photographer       = ' + ', '.join(filter(None, metadata['creator']))
-        description += '''
-|depicted people    =
-|permission         =
-|other_versions     =
-|wikidata           =
-|camera coord       =
-}}
-
-=={{int:license-header}}==
-'''
-        for license_meta in metadata['rights']:
-            if license_meta.lower() in self.Licenses:
-                description += self.Licenses[license_meta.lower()]
-
-        description += '[[Category:{} (Arkivverket)]]\n'.format(metadata['CustomField18']) if metadata[
-                                                                                                  'CustomField18'] and \
-                                                                                              metadata[
-                                                                                                  'CustomField18'] != \
-                                                                                              '' else '[[Category' \
-                                                                                                      ':Media ' \
-                                                                                                      'from the ' \
-                                                                                                      'National ' \
-                                                                                                      'Archives of ' \
-                                                                                                      'Norway]] '
-        if metadata['Country']:
-            country_picker = countryTrans[metadata['Country'].lower()]
-            description += '[[Category:{} in {}]]'.format(dateFix[0:4],
-                                                          country_picker) if dateFix and \
-                                                                             country_picker != '' else ''
-
-        if metadata['UserDefined233'].lower() == 'ja':
+        :return: return the file name on Commons and the wikitext of the file page, or None if it is skipped
+        :rtype: the return type tuple
+        """
+        describe_start = time.perf_counter()
+        file_ending_local = file_ending.lower()
+        if file_ending.lower() == 'small_jpg' or file_ending.lower() == 'big_jpg':
+            file_ending_local = '.jpg'
+
+        use_filename, description = self.renderer.render(metadata, file_ending_local)
+        self.metrics.add('describe', time.perf_counter() - describe_start)
+
+        src = metadata['source'][len(self.urlDA):]
+        if metadata['UserDefined233'].lower() == 'ja' and metadata['source'] not in self.dont_upload:
             self.dont_upload.append(metadata['source'])
 
         if metadata['source'] in self.dont_upload:
-            return 0
+            self.metrics.incr('skipped_restricted')
+            self._record(src, 'restricted')
+            self._drop_spool(metadata['href'])
+            return None
 
-        page = pywikibot.Page(commons, "File:" + use_filename)
-        if page.exists():
+        if self.state is not None and not self.state.claim_title(use_filename, src):  # Name taken by another image
+            print("image exist!")
+            self.metrics.incr('skipped_exists')
+            self._record(src, 'exists', title=use_filename)
+            self._drop_spool(metadata['href'])
+            return None
+
+        exists = self.commons_check.exists(use_filename) if self.commons_check else None
+        if exists is None:
+            with self.metrics.time('commons_exists'):
+                exists = self._commons_exists(commons, use_filename)
+        if exists:
             # if page.text == description:
             print("image exist!")
-            return 0  # Exists
+            self.metrics.incr('skipped_exists')
+            self._record(src, 'exists', title=use_filename)
+            self._drop_spool(metadata['href'])
+            return None  # Exists
 
-        bot = UploadRobot(url, description=description, use_filename=use_filename,
-                          keep_filename=keep_filename,
-                          verify_description=verify_description, aborts=aborts,
-                          chunk_size=chunk_size, ignore_warning=ignore_warning,
-                          always=always, summary=summary,
-                          filename_prefix=filename_prefix, target_site=commons)
-        bot.run()
+        return use_filename, description
 
-        # print(description)
-        # print(use_filename)
+    def prepare_upload(self, metadata, commons, file_ending=".tif"):
+        """
+        prepare_upload
+        @param metadata: Metadata of an image that is going to be uploaded.
+        @type metadata: dict
+        @param commons: site that is used for upload
+        @type commons: pywikibot.site.APISite
+        @param file_ending: File extension including the dot, e.g. ".tif".
+        @type file_ending: str
+
+        Check the image before "media_upload" and start downloading it in the "chunked" upload mode, so no
+        file that is skipped is downloaded.
+
+        :return: return False if the image is skipped
+        :rtype: the return type bool
+        """
+        checked = self._check_upload(metadata, commons, file_ending)
+        if checked is None:
+            return False
+        self._checked[metadata['href']] = checked
+        self.prefetch(metadata, file_ending)
+        return True
+
+    def _commons_exists(self, commons, use_filename):
+        return pywikibot.Page(commons, "File:" + use_filename).exists()
+
+    def _commons_upload(self, commons, href, description, use_filename, summary):
+        """
+        Upload the image at "href" to Commons by URL, raises if Commons did not take it.
+        """
+        if not commons.has_right('upload_by_url'):  # Download the image and send it in chunks instead
+            spooled = self._spool(href)
+            try:
+                self._commons_upload_file(commons, spooled, description, use_filename, summary)
+            finally:
+                spooled.close()
+            return
+        imagepage = pywikibot.FilePage(commons, use_filename)
+        imagepage.text = description
+        if not imagepage.upload(href, ignore_warnings=True, chunk_size=0, summary=summary):
+            raise TypeError(
+                f"Upload of {use_filename} was not accepted"
+            )
+
+    def _commons_upload_file(self, commons, spooled, description, use_filename, summary):
+        """
+        Upload the spooled image to Commons in chunks, continuing from the upload stash after an error.
+        """
+        uploader = self._uploaders.get(commons)
+        if uploader is None:
+            uploader = self._uploaders.setdefault(commons, ChunkedUpload(self._chunk_post(commons), self.chunk_size))
+        uploader.upload(spooled, use_filename, description, summary)
+
+    def _chunk_post(self, commons):
+        return site_post(commons)
+
+    def prefetch(self, metadata, file_ending=".tif"):
+        """
+        prefetch
+        @param metadata: Metadata of an image that is going to be uploaded.
+        @type metadata: dict
+        @param file_ending: File extension including the dot, e.g. ".tif".
+        @type file_ending: str
+
+        Start downloading the image in the "chunked" upload mode, so it is ready when the upload before it is done.
+        Restricted images and images known to be on Commons are not downloaded.
+        """
+        if self._spool_pool is None or metadata['href'] in self._spools:
+            return
+        if metadata['UserDefined233'].lower() == 'ja' or metadata['source'] in self.dont_upload:
+            return
+        if self.commons_check and self.commons_check.titles.get(self.file_name(metadata, file_ending)):
+            return
+        self._spools[metadata['href']] = self._spool_pool.submit(self._spool, metadata['href'])
+
+    def _spool(self, href):
+        with self.metrics.time('spool'):
+            return spool(self._S, href, self.spoolMaxMemory, metrics=self.metrics)
+
+    def _spooled(self, href):
+        future = self._spools.pop(href, None)
+        if future is None:
+            return self._spool(href)
+        with self.metrics.time('spool_wait'):
+            return future.result()
+
+    def _drop_spool(self, href):
+        future = self._spools.pop(href, None)
+        if future is not None and not future.cancel():
+            future.add_done_callback(lambda done: done.exception() is None and done.result().close())
+
+    def _upload_files(self, files, commons, file_ending, summary):
+        """
+        Describe, check and upload the files of finished download tasks. The next image is checked (and
+        downloaded in the "chunked" upload mode) while the one before it uploads.
+        """
+        waiting = deque()
+        try:
+            for img in files:
+                meta = self.collect_metadata(img['src'], img['href'], file_ending)
+                if not self.prepare_upload(meta, commons, self.File_ending[file_ending]):
+                    continue
+                waiting.append(meta)
+                if len(waiting) > 1:
+                    self.media_upload(waiting.popleft(), commons, self.File_ending[file_ending], summary)
+            while waiting:
+                self.media_upload(waiting.popleft(), commons, self.File_ending[file_ending], summary)
+        finally:
+            for meta in waiting:  # Not uploaded after an error
+                self._checked.pop(meta['href'], None)
+                self._drop_spool(meta['href'])
 
     def handle_upload(self, page_list, commons, file_ending="tif", summary=""):
         """
@@ -456,14 +1014,17 @@ class Client:
         @param summary: Upload comment for each image. Allows Wikitext. Default None.
         @type summary: str
         """
-        location = self._post(page_list, self.Size[file_ending])
-        result = self._get(location)
-
-        for img in result['job']['result']['files']:
-            meta = self.get_metadata(img['src'], img['href'], file_ending)
-            self.media_upload(meta, commons, self.File_ending[file_ending], summary)
+        if self.state is not None:
+            page_list = self.state.pending(page_list)
+            if not page_list:
+                return
+        self._upload_files(self.iter_files(file_ending, page_list, in_flight=1), commons, file_ending, summary)
+        if self.poller.failed:
+            raise TypeError(
+                f"Background task for {', '.join(page_list)} failed: {self.poller.failed[0][1]}"
+            )
 
-    def upload(self, commons, file_ending="tif", summary=""):
+    def upload(self, commons, file_ending="tif", summary="", in_flight=4):
         """
         upload
         @param commons: site that is used for upload
@@ -472,18 +1033,53 @@ class Client:
         @type file_ending: str
         @param summary: Upload comment for each image. Allows Wikitext. Default None.
         @type summary: str
+        @param in_flight: Max amount of download tasks waiting on the server at the same time.
+        @type in_flight: int
         """
         if self.pages and file_ending in self.File_ending:
-            for num, val in enumerate(self.pages, start=1):
-                if num % 4 == 0:
-                    self.handle_upload(self.pages[num - 4:num], commons, file_ending, summary)
-                    print("sleep 30 sec.")
-                    time.sleep(30)
-                elif val == self.pages[-1]:
-                    self.handle_upload(self.pages[(len(self.pages) % 4) * -1::], commons, file_ending, summary)
+            pages = self.state.pending(self.pages) if self.state is not None else self.pages
+            self._upload_files(self.iter_files(file_ending, pages, in_flight), commons, file_ending, summary)
+            if self.poller.failed:
+                raise TypeError(
+                    f"Background tasks for {sum(len(batch) for batch, _ in self.poller.failed)} images failed, "
+                    f"last: {self.poller.failed[-1][1]}"
+                )
             print("Done")
             return 0
         else:
             raise TypeError(
                 f"File type is out of the scope or there is nothing to upload."
             )
+
+    def run(self, commons, file_ending="tif", summary="", workers=None, queue_size=8, query=None):
+        """
+        run
+        @param commons: site that is used for upload
+        @type commons: pywikibot.site.APISite
+        @param file_ending: Size for the image. Most be in "self.Size". Default "tif".
+        @type file_ending: str
+        @param summary: Upload comment for each image. Allows Wikitext. Default None.
+        @type summary: str
+        @param workers: Amount of download tasks in flight ("poll") and threads per stage ("metadata", "upload").
+            Default "Pipeline.Workers".
+        @type workers: dict
+        @param queue_size: Max amount of items waiting between two stages.
+        @type queue_size: int
+        @param query: Search term used for finding images. The upload starts while the later pages of the result
+            are still loading. Default upload "self.pages".
+        @type query: str
+
+        :return: return the wall time and the throughput of each stage
+        :rtype: the return type dict
+        """
+        if query is None and not self.pages:
+            raise TypeError(
+                f"There is nothing to upload."
+            )
+        pages = self.iter_query(query) if query is not None else self.pages
+        if self.state is not None:
+            pages = (page for page in pages if not self.state.is_done(page))
+        report = Pipeline(self, commons, file_ending, summary, pages=pages, workers=workers,
+                          queue_size=queue_size).run()
+        print("Done")
+        return report
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import json
+import os
+
+
+class Preflight:
+    """
+        Batched existence and duplicate checks against Wikimedia Commons.
+
+        File titles are resolved with multi-title queries (50 per request, 500 with the
+        "apihighlimits" right) and content duplicates with "list=allimages&aisha1=".
+        Every answer is kept in a local cache, optionally stored as a JSON file, so a
+        rerun does not ask Commons again.
+
+        Example usage:
+            pre = Preflight(commons, cache_file="commons-cache.json")
+            existing = pre.existing(["Foo (RA-123).tif", "Bar (RA-124).tif"])
+            pre.save()
+    """
+
+    def __init__(self, site, cache_file=None, batch_size=None):
+        """
+        __init__
+        @param site: site that is used for upload
+        @type site: pywikibot.site.APISite
+        @param cache_file: JSON file the answers are loaded from and saved to. Default no file.
+        @type cache_file: str
+        @param batch_size: Titles per request. Default 500 with "apihighlimits", else 50.
+        @type batch_size: int
+        """
+        self.site = site
+        self.cache_file = cache_file
+        self.batch_size = batch_size
+        self.titles = {}  # file name -> True if it exists on Commons
+        self.sha1 = {}  # sha1 -> names of the files on Commons with that content
+        self.requests = 0
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, encoding='utf-8') as f:
+                data = json.load(f)
+            self.titles = data.get('titles', {})
+            self.sha1 = data.get('sha1', {})
+
+    def save(self):
+        if self.cache_file:  # Only files that exist are kept, missing ones may have been uploaded since
+            with open(self.cache_file, 'w', encoding='utf-8') as f:
+                json.dump({'titles': {name: True for name, found in self.titles.items() if found},
+                           'sha1': {sha1: names for sha1, names in self.sha1.items() if names}}, f)
+
+    def uploaded(self, filename):
+        """
+        Remember that "filename" now exists on Commons.
+        """
+        self.titles[filename] = True
+
+    def _batch_size(self):
+        if self.batch_size is None:
+            self.batch_size = 500 if self.site.has_right('apihighlimits') else 50
+        return self.batch_size
+
+    def _query(self, **params):
+        self.requests += 1
+        return self.site.simple_request(action='query', formatversion=2, **params).submit()
+
+    def exists(self, filename):
+        """
+        exists
+        @param filename: File name without the "File:" prefix.
+        @type filename: str
+
+        :return: return True or False if the answer is cached, else None
+        :rtype: the return type bool
+        """
+        return self.titles.get(filename)
+
+    def existing(self, filenames):
+        """
+        existing
+        @param filenames: File names without the "File:" prefix.
+        @type filenames: iterable
+
+        :return: return the file names that already exist on Commons
+        :rtype: the return type set
+        """
+        filenames = list(dict.fromkeys(filenames))
+        unknown = [name for name in filenames if name not in self.titles]
+        size = self._batch_size()
+
+        for i in range(0, len(unknown), size):
+            batch = unknown[i:i + size]
+            titles = {'File:' + name: name for name in batch}
+            data = self._query(titles='|'.join(titles)).get('query', {})
+            for norm in data.get('normalized', []):  # Commons may rewrite the title, e.g. "_" to " "
+                if norm['from'] in titles:
+                    titles[norm['to']] = titles[norm['from']]
+            for page in data.get('pages', []):
+                name = titles.get(page['title'])
+                if name is not None:
+                    self.titles[name] = 'missing' not in page and 'invalid' not in page
+            for name in batch:  # Titles Commons did not answer for count as missing
+                self.titles.setdefault(name, False)
+
+        return {name for name in filenames if self.titles[name]}
+
+    def duplicates(self, sha1s):
+        """
+        duplicates
+        @param sha1s: SHA-1 hex digests of the files to upload.
+        @type sha1s: iterable
+
+        :return: return the digests that are already on Commons, mapped to the names of those files
+        :rtype: the return type dict
+        """
+        found = {}
+        for sha1 in dict.fromkeys(sha1s):
+            sha1 = sha1.lower()
+            if sha1 not in self.sha1:
+                data = self._query(list='allimages', aisha1=sha1, ailimit='max').get('query', {})
+                self.sha1[sha1] = [img['title'].split(':', 1)[1] for img in data.get('allimages', [])]
+                for name in self.sha1[sha1]:
+                    self.titles[name] = True
+            if self.sha1[sha1]:
+                found[sha1] = self.sha1[sha1]
+        return found
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import json
+import sqlite3
+import threading
+import time
+
+from requests.adapters import BaseAdapter
+
+
+class HttpCache:
+    """
+        Size bounded on-disk cache of HTTP responses and values derived from them, in one SQLite file.
+
+        Every entry is keyed by href and stored with the ETag and Last-Modified it was valid for.
+        A cached entry is never used without asking the server first: responses are revalidated
+        with If-None-Match / If-Modified-Since, and derived values (XMP metadata) only match while
+        their validator is unchanged. The least recently used entries are removed when the file
+        grows over "max_bytes".
+
+        Example usage:
+            r = d2c.Client(cache="d2c-cache.sqlite")
+            r.query(...)
+            print(r.cache.stats())
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, max_entry=4 * 1024 * 1024):
+        """
+        __init__
+        @param path: SQLite file. Created if it does not exist, ":memory:" for no file.
+        @type path: str
+        @param max_bytes: Max size of all cached bodies and values, older entries are removed first.
+        @type max_bytes: int
+        @param max_entry: Responses larger than this are not cached.
+        @type max_entry: int
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entry = max_entry
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            if path != ':memory:':
+                self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                                    key TEXT PRIMARY KEY,
+                                    etag TEXT,
+                                    last_modified TEXT,
+                                    headers TEXT,
+                                    body BLOB NOT NULL,
+                                    size INTEGER NOT NULL,
+                                    used REAL NOT NULL)''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+            self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get(self, key):
+        """
+        get
+        @param key: href of the entry.
+        @type key: str
+
+        :return: return the entry with "etag", "last_modified", "headers" and "body", or None
+        :rtype: the return type dict
+        """
+        with self._lock:
+            row = self._db.execute('SELECT etag, last_modified, headers, body FROM entries WHERE key = ?',
+                                   (key,)).fetchone()
+        if row is None:
+            return None
+        return {'etag': row['etag'], 'last_modified': row['last_modified'],
+                'headers': json.loads(row['headers'] or '{}'), 'body': bytes(row['body'])}
+
+    def put(self, key, body, etag=None, last_modified=None, headers=None):
+        """
+        put
+        @param key: href of the entry.
+        @type key: str
+        @param body: Response body or encoded value.
+        @type body: bytes
+        @param etag: ETag the entry is valid for.
+        @type etag: str
+        @param last_modified: Last-Modified the entry is valid for.
+        @type last_modified: str
+        @param headers: Response headers kept with the body.
+        @type headers: dict
+        """
+        if len(body) > self.max_entry:
+            return
+        with self._lock, self._db:
+            old = self._db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO entries (key, etag, last_modified, headers, body, size, used) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (key, etag, last_modified, json.dumps(headers or {}), body, len(body), time.time()))
+            self._size += len(body) - (old['size'] if old else 0)
+            self.stored += 1
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        target = self.max_bytes * 0.9  # Leave some room so the next puts do not evict again
+        for row in self._db.execute('SELECT key, size FROM entries ORDER BY used').fetchall():
+            if self._size <= target:
+                break
+            self._db.execute('DELETE FROM entries WHERE key = ?', (row['key'],))
+            self._size -= row['size']
+            self.evicted += 1
+
+    def touch(self, key):
+        with self._lock, self._db:
+            self._db.execute('UPDATE entries SET used = ? WHERE key = ?', (time.time(), key))
+
+    def hit(self, key):
+        self.touch(key)
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def get_value(self, key, validator):
+        """
+        get_value
+        @param key: Key of a value derived from a response, e.g. the metadata of an image.
+        @type key: str
+        @param validator: ETag or modified time of the source the value was derived from.
+        @type validator: str
+
+        :return: return the value if it was stored for the same validator, else None
+        :rtype: the return type object
+        """
+        entry = self.get(key) if validator else None
+        if entry is None or entry['etag'] != validator:
+            self.miss()
+            return None
+        self.hit(key)
+        return json.loads(entry['body'])
+
+    def put_value(self, key, validator, value):
+        if validator:
+            self.put(key, json.dumps(value).encode(), etag=validator)
+
+    def stats(self):
+        """
+        stats
+
+        :return: return the hits, misses, hit ratio, stored and evicted entries and the cache size in bytes
+        :rtype: the return type dict
+        """
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+                'stored': self.stored,
+                'evicted': self.evicted,
+                'entries': entries,
+                'bytes': self._size,
+            }
+
+
+class CachingAdapter(BaseAdapter):
+    """
+        Transport adapter that revalidates GET responses against an HttpCache.
+
+        A cached response is sent with If-None-Match / If-Modified-Since, and a 304 answer is
+        turned back into the cached 200 response, so callers see the full body. Only listing
+        pages and asset records are cached: renditions are large and fetched once, and would push
+        them out. Requests with their own conditional or Range headers pass through uncached.
+    """
+
+    Conditional = ('If-None-Match', 'If-Modified-Since', 'Range')
+
+    # Accept types of the responses that are cached.
+    Cached = ('application/vnd.fotoware.assetlist+json', 'application/vnd.fotoware.asset+json')
+
+    def __init__(self, cache, adapter, metrics=None):
+        """
+        __init__
+        @param cache: Where the responses are kept.
+        @type cache: HttpCache
+        @param adapter: Adapter that sends the requests.
+        @type adapter: requests.adapters.BaseAdapter
+        @param metrics: Metrics the cache hits and misses are counted in.
+        @type metrics: d2c.metrics.Metrics
+        """
+        super().__init__()
+        self.cache = cache
+        self.adapter = adapter
+        self.metrics = metrics
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.incr(name)
+
+    def send(self, request, stream=False, **kwargs):
+        accept = request.headers.get('Accept', '')
+        if (request.method != 'GET' or stream or any(h in request.headers for h in self.Conditional)
+                or not any(accept.startswith(kind) for kind in self.Cached)):
+            return self.adapter.send(request, stream=stream, **kwargs)
+
+        entry = self.cache.get(request.url)
+        if entry is not None:
+            if entry['etag']:
+                request.headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                request.headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.adapter.send(request, stream=stream, **kwargs)
+        response.from_cache = False
+        if entry is not None and response.status_code == 304:
+            response.content  # Read the empty body so the connection goes back to the pool
+            response.status_code = 200
+            response.reason = 'OK'
+            response.headers.update(entry['headers'])
+            response._content = entry['body']
+            response.from_cache = True
+            self.cache.hit(request.url)
+            self._count('cache_hits')
+            return response
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        cacheable = response.status_code == 200 and (etag or last_modified)
+        if entry is not None or cacheable:  # Responses without validators, like task status, are not counted
+            self.cache.miss()
+            self._count('cache_misses')
+        if cacheable:
+            headers = {key: value for key, value in response.headers.items()
+                       if key.lower() in ('content-type', 'etag', 'last-modified')}
+            self.cache.put(request.url, response.content, etag, last_modified, headers)
+        return response
+
+    def close(self):
+        self.adapter.close()
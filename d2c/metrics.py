@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# Held while a stage is profiled. Since Python 3.12 only one cProfile can be active in the whole process.
+_profiling = threading.Lock()
+
+
+class Metrics:
+    """
+        Timers and counters for every stage of a harvest, shared by every thread of a Client.
+
+        Timers record count, total and max seconds per stage, counters are plain numbers
+        (bytes, retries, skips, failures). The values can be read with "snapshot", written
+        as JSON or Prometheus text, and dumped to a file every few seconds.
+
+        Example usage:
+            r = d2c.Client(metrics=Metrics(profile=['metadata_parse']))
+            r.metrics.start_dump("metrics.prom", interval=30, fmt="prometheus")
+            ...
+            print(r.metrics.to_json())
+            r.metrics.print_profile('metadata_parse')
+    """
+
+    def __init__(self, profile=None):
+        """
+        __init__
+        @param profile: Stages to run under cProfile, True for every stage. Default none. One stage is profiled at
+            a time, a stage that starts while another one is profiled is only timed.
+        @type profile: list
+        """
+        self.profile = profile
+        self.timers = {}  # stage -> [count, total seconds, max seconds]
+        self.counters = {}
+        self.profiles = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._dump = None
+
+    def add(self, stage, seconds):
+        """
+        Record one run of "stage" that took "seconds".
+        """
+        with self._lock:
+            timer = self.timers.setdefault(stage, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def _profiled(self, stage):
+        return self.profile is True or (self.profile and stage in self.profile)
+
+    @contextmanager
+    def time(self, stage):
+        """
+        Time the body of the "with" block as one run of "stage".
+        """
+        profiler = None
+        if self._profiled(stage) and _profiling.acquire(blocking=False):  # Else another stage is profiled now
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:  # Another profiling tool is active
+                profiler = None
+                _profiling.release()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+            if profiler is not None:
+                profiler.disable()
+                _profiling.release()
+                with self._lock:
+                    if stage in self.profiles:
+                        self.profiles[stage].add(profiler)
+                    else:
+                        self.profiles[stage] = pstats.Stats(profiler)
+
+    def print_profile(self, stage, sort='cumulative', limit=25):
+        """
+        print_profile
+        @param stage: Stage that was profiled.
+        @type stage: str
+        @param sort: pstats sort key.
+        @type sort: str
+        @param limit: Amount of functions to show.
+        @type limit: int
+        """
+        with self._lock:
+            stats = self.profiles.get(stage)
+            if stats is None:
+                print("no profile for {}".format(stage))
+                return
+            out = io.StringIO()
+            stats.stream = out
+            stats.sort_stats(sort).print_stats(limit)
+        print(out.getvalue())
+
+    def snapshot(self):
+        """
+        snapshot
+
+        :return: return the timers and counters at this moment
+        :rtype: the return type dict
+        """
+        with self._lock:
+            return {
+                'uptime': round(time.time() - self.started, 3),
+                'timers': {stage: {'count': count, 'seconds': round(total, 6), 'max': round(longest, 6),
+                                   'mean': round(total / count, 6) if count else 0.0}
+                           for stage, (count, total, longest) in sorted(self.timers.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self, prefix='d2c'):
+        """
+        to_prometheus
+        @param prefix: Prefix of every metric name.
+        @type prefix: str
+
+        :return: return the timers and counters in the Prometheus text format
+        :rtype: the return type str
+        """
+        snap = self.snapshot()
+        lines = [
+            '# TYPE {}_stage_seconds_total counter'.format(prefix),
+            '# TYPE {}_stage_runs_total counter'.format(prefix),
+            '# TYPE {}_stage_seconds_max gauge'.format(prefix),
+        ]
+        for stage, timer in snap['timers'].items():
+            lines.append('{}_stage_seconds_total{{stage="{}"}} {}'.format(prefix, stage, timer['seconds']))
+            lines.append('{}_stage_runs_total{{stage="{}"}} {}'.format(prefix, stage, timer['count']))
+            lines.append('{}_stage_seconds_max{{stage="{}"}} {}'.format(prefix, stage, timer['max']))
+        for name, value in snap['counters'].items():
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total {}'.format(prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, fmt='json'):
+        """
+        write
+        @param path: File the metrics are written to, replaced every time.
+        @type path: str
+        @param fmt: "json" or "prometheus".
+        @type fmt: str
+        """
+        text = self.to_prometheus() if fmt == 'prometheus' else self.to_json()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def start_dump(self, path, interval=60, fmt='json'):
+        """
+        start_dump
+        @param path: File the metrics are written to every "interval" seconds.
+        @type path: str
+        @param interval: Seconds between two dumps.
+        @type interval: float
+        @param fmt: "json" or "prometheus".
+        @type fmt: str
+        """
+        if fmt not in ('json', 'prometheus'):
+            raise TypeError(
+                f"Metrics format, {fmt}, is out of the scope"
+            )
+        self.stop_dump()
+        stop = threading.Event()
+
+        def dump():
+            while not stop.wait(interval):
+                self.write(path, fmt)
+            self.write(path, fmt)
+
+        thread = threading.Thread(target=dump, daemon=True)
+        thread.start()
+        self._dump = (stop, thread)
+
+    def stop_dump(self):
+        if self._dump is not None:
+            stop, thread = self._dump
+            stop.set()
+            thread.join()
+            self._dump = None
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from .transport import Transport
+
+# Category the uploads of this tool end up in, directly or through a subcategory.
+Category = 'Media from the National Archives of Norway'
+
+
+def dhash(data, size=8):
+    """
+    dhash
+    @param data: Bytes of an image file, a small rendition is enough.
+    @type data: bytes
+    @param size: Bits per side, the hash has size * size bits.
+    @type size: int
+
+    :return: return the difference hash of the image: for each pixel of a size + 1 by size grey scale
+        thumbnail, whether it is brighter than the pixel on its right
+    :rtype: the return type int
+    """
+    with Image.open(BytesIO(data)) as img:
+        img.draft('L', (size * 8, size * 8))  # Let the JPEG decoder scale down, much faster for big images
+        pixels = list(img.convert('L').resize((size + 1, size), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            pos = row * (size + 1) + col
+            bits = (bits << 1) | (pixels[pos] > pixels[pos + 1])
+    return bits
+
+
+def distance(first, second):
+    """
+    Amount of bits that differ between two hashes.
+    """
+    return bin(first ^ second).count('1')
+
+
+class BKTree:
+    """
+        Burkhard-Keller tree of hashes, finds every hash within a Hamming distance without
+        comparing against all of them.
+
+        Every node keeps its children by their distance to the node, so a search for
+        "value" within "max_distance" only goes into children whose distance to the node
+        is within "max_distance" of the distance from "value" to the node.
+    """
+
+    def __init__(self):
+        self.root = None  # [hash, items, {distance: child}]
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            dist = distance(value, node[0])
+            if dist == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(dist)
+            if child is None:
+                node[2][dist] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """
+        search
+        @param value: Hash to look for.
+        @type value: int
+        @param max_distance: Max amount of differing bits.
+        @type max_distance: int
+
+        :return: return (distance, item) for every item within "max_distance", nearest first
+        :rtype: the return type list
+        """
+        found = []
+        todo = [self.root] if self.root is not None else []
+        while todo:
+            node = todo.pop()
+            dist = distance(value, node[0])
+            if dist <= max_distance:
+                found.extend((dist, item) for item in node[1])
+            for child_dist, child in node[2].items():
+                if dist - max_distance <= child_dist <= dist + max_distance:
+                    todo.append(child)
+        return sorted(found)
+
+
+class HashIndex:
+    """
+        Perceptual hashes of files on Commons and of the images seen so far, in a BK-tree.
+
+        The hashes of the Commons files are kept in a JSON file, so only files added to the
+        category since the last run are downloaded again.
+
+        Example usage:
+            index = HashIndex("phash-cache.json")
+            index.add_category(commons, transport=r.transport)
+            near = index.find(dhash(small_jpg_bytes))
+            index.save()
+    """
+
+    def __init__(self, cache_file=None, max_distance=6):
+        """
+        __init__
+        @param cache_file: JSON file the hashes of Commons files are loaded from and saved to. Default no file.
+        @type cache_file: str
+        @param max_distance: Max amount of differing bits (out of 64) for two images to count as the same.
+        @type max_distance: int
+        """
+        self.cache_file = cache_file
+        self.max_distance = max_distance
+        self.hashes = {}  # Commons file name -> hash
+        self.tree = BKTree()
+        self._lock = threading.Lock()
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, encoding='utf-8') as f:
+                for name, value in json.load(f).items():
+                    self.add(name, int(value, 16))
+
+    def add(self, name, value, commons=True):
+        """
+        add
+        @param name: Commons file name, or the image page of an image seen in this run.
+        @type name: str
+        @param value: Hash of the image.
+        @type value: int
+        @param commons: Whether "name" is a file on Commons, only those are saved.
+        @type commons: bool
+        """
+        with self._lock:
+            if commons:
+                if name in self.hashes:
+                    return
+                self.hashes[name] = value
+            self.tree.add(value, name)
+
+    def find(self, value):
+        """
+        find
+        @param value: Hash of the image.
+        @type value: int
+
+        :return: return (distance, name) for every indexed image within "max_distance", nearest first
+        :rtype: the return type list
+        """
+        with self._lock:
+            return self.tree.search(value, self.max_distance)
+
+    def save(self):
+        if self.cache_file:
+            with self._lock:
+                data = {name: '{:016x}'.format(value) for name, value in self.hashes.items()}
+            with open(self.cache_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+
+    def _category_files(self, site, category, depth, width):
+        """
+        Yield (file name, thumbnail URL) for every file in the category and its subcategories.
+        """
+        seen = set()
+        todo = [(category, depth)]
+        while todo:
+            title, level = todo.pop()
+            if title in seen:
+                continue
+            seen.add(title)
+            params = {'generator': 'categorymembers', 'gcmtitle': 'Category:' + title,
+                      'gcmtype': 'file|subcat' if level > 0 else 'file', 'gcmlimit': 'max',
+                      'prop': 'imageinfo', 'iiprop': 'url', 'iiurlwidth': width}
+            while True:
+                data = site.simple_request(action='query', formatversion=2, **params).submit()
+                for page in data.get('query', {}).get('pages', []):
+                    if page['ns'] == 14:
+                        todo.append((page['title'].split(':', 1)[1], level - 1))
+                    elif page.get('imageinfo'):
+                        info = page['imageinfo'][0]
+                        yield page['title'].split(':', 1)[1], info.get('thumburl') or info['url']
+                if 'continue' not in data:
+                    break
+                params.update(data['continue'])
+
+    def add_category(self, site, category=Category, depth=1, transport=None, width=120, workers=4):
+        """
+        add_category
+        @param site: site that is used for upload
+        @type site: pywikibot.site.APISite
+        @param category: Category name without the "Category:" prefix.
+        @type category: str
+        @param depth: How many levels of subcategories are included.
+        @type depth: int
+        @param transport: Transport the thumbnails are downloaded with, one session per thread. Default a new one.
+        @type transport: d2c.transport.Transport
+        @param width: Width in pixels of the thumbnails that are hashed.
+        @type width: int
+        @param workers: Thumbnails downloaded at the same time.
+        @type workers: int
+
+        :return: return the amount of files hashed, files already in the index are skipped
+        :rtype: the return type int
+        """
+        transport = transport or Transport(pool_size=workers)
+        todo = [(name, url) for name, url in self._category_files(site, category, depth, width)
+                if name not in self.hashes]
+
+        def hash_file(item):
+            name, url = item
+            try:
+                response = transport.session.get(url)
+                response.raise_for_status()
+                return name, dhash(response.content)
+            except Exception as e:  # A broken file should not stop the rest
+                print("could not hash {}: {}".format(name, e))
+                return name, None
+
+        added = 0
+        with ThreadPoolExecutor(workers) as pool:
+            for name, value in pool.map(hash_file, todo):
+                if value is not None:
+                    self.add(name, value)
+                    added += 1
+        return added
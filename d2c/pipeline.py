@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+import queue
+import threading
+import time
+import traceback
+
+from .tasks import TaskPoller
+
+_STOP = object()  # Sentinel telling a worker that its input queue is finished
+
+
+class Stage:
+    """
+        One step of the pipeline, run by "workers" threads.
+
+        "func" is called with one item from the input queue and returns an iterable
+        with the items for the next stage, so a stage can drop, pass on or fan out items.
+    """
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+        self._running = 0
+
+    def stats(self, elapsed):
+        """
+        stats
+        @param elapsed: Wall time of the whole run in seconds.
+        @type elapsed: float
+
+        :return: return the counters and throughput of the stage
+        :rtype: the return type dict
+        """
+        return {
+            'workers': self.workers,
+            'items_in': self.items_in,
+            'items_out': self.items_out,
+            'errors': self.errors,
+            'busy_seconds': round(self.busy, 3),
+            'items_per_sec': round(self.items_in / elapsed, 3) if elapsed else 0.0,
+        }
+
+
+class Pipeline:
+    """
+        Runs query -> download tasks -> metadata -> upload as concurrent stages.
+
+        The download tasks are created and polled by one TaskPoller, which keeps several of
+        them in flight. The stages are connected by bounded queues, so a slow stage makes the
+        stages in front of it wait instead of piling up work in memory.
+
+        Example usage:
+            p = Pipeline(client, commons, file_ending="tif", summary="...", workers={'upload': 2})
+            report = p.run()
+    """
+
+    # Default amount of download tasks in flight ("poll") and threads for each other stage.
+    Workers = {
+        'poll': 8,
+        'metadata': 4,
+        'upload': 1,
+    }
+
+    def __init__(self, client, commons, file_ending="tif", summary="", pages=None, workers=None, queue_size=8,
+                 batch_size=4):
+        """
+        __init__
+        @param client: Client used for every request.
+        @type client: d2c.Client
+        @param commons: site that is used for upload
+        @type commons: pywikibot.site.APISite
+        @param file_ending: Size for the image. Most be in "client.Size". Default "tif".
+        @type file_ending: str
+        @param summary: Upload comment for each image. Allows Wikitext. Default None.
+        @type summary: str
+        @param pages: Image pages to upload. Default "client.pages".
+        @type pages: iterable
+        @param workers: Amount of download tasks in flight and threads per stage, overrides "Pipeline.Workers".
+        @type workers: dict
+        @param queue_size: Max amount of items waiting between two stages.
+        @type queue_size: int
+        @param batch_size: Images per download task, FotoWare takes max 4.
+        @type batch_size: int
+        """
+        if file_ending not in client.File_ending:
+            raise TypeError(
+                f"File type, {file_ending}, is out of the scope"
+            )
+        self.client = client
+        self.commons = commons
+        self.file_ending = file_ending
+        self.summary = summary
+        self.pages = pages
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+
+        workers = dict(self.Workers, **(workers or {}))
+        self.stages = [
+            Stage('metadata', self._metadata, workers['metadata']),
+            Stage('upload', self._upload, workers['upload']),
+        ]
+        self.source = Stage('query', None, 1)
+        self.tasks = Stage('poll', None, workers['poll'])
+        self.poller = TaskPoller(client, client.Size[file_ending], in_flight=workers['poll'], batch_size=batch_size)
+
+    def _pages(self):
+        stage = self.source
+        try:
+            for page in self.client.pages if self.pages is None else self.pages:
+                stage.items_in += 1
+                stage.items_out += 1
+                yield page
+        except Exception as e:
+            stage.errors += 1
+            print("query failed: {}".format(e))
+
+    def _page(self, item):
+        """
+        Image page of an item of any stage, a file of a download task or a metadata dict.
+        """
+        if 'src' in item:
+            return item['src']
+        return item['source'][len(self.client.urlDA):]
+
+    def _metadata(self, img):
+        meta = self.client.collect_metadata(img['src'], img['href'], self.file_ending)
+        # Skipped images go no further, the others download while earlier ones upload
+        if self.client.prepare_upload(meta, self.commons, self.client.File_ending[self.file_ending]):
+            yield meta
+
+    def _upload(self, meta):
+        self.client.media_upload(meta, self.commons, self.client.File_ending[self.file_ending], self.summary)
+        return ()
+
+    def _feed(self, outq, workers):
+        stage = self.tasks
+        try:
+            for img in self.poller.run(self._pages()):
+                stage.items_out += 1
+                outq.put(img)
+        except Exception as e:
+            stage.errors += 1
+            print("poll failed: {}".format(e))
+        finally:
+            stage.items_in = len(self.poller.latencies) + len(self.poller.failed)
+            stage.errors += len(self.poller.failed)
+            for _ in range(workers):
+                outq.put(_STOP)
+
+    def _work(self, stage, inq, outq, next_workers):
+        while True:
+            item = inq.get()
+            if item is _STOP:
+                break
+            start = time.perf_counter()
+            try:
+                for out in stage.func(item):
+                    with stage._lock:
+                        stage.items_out += 1
+                    if outq is not None:
+                        outq.put(out)
+            except Exception as e:
+                with stage._lock:
+                    stage.errors += 1
+                page = self._page(item)
+                print("{} failed for {}: {!r}\n{}".format(stage.name, page, e, traceback.format_exc()), end='')
+                if self.client.state is not None and not self.client.state.is_done(page):
+                    self.client._record(page, 'failed', error=repr(e))
+            with stage._lock:
+                stage.items_in += 1
+                stage.busy += time.perf_counter() - start
+
+        with stage._lock:  # The last worker of a stage closes the queue of the next one
+            stage._running -= 1
+            last = stage._running == 0
+        if last and outq is not None:
+            for _ in range(next_workers):
+                outq.put(_STOP)
+
+    def run(self):
+        """
+        run
+
+        :return: return the wall time, the counters and throughput of each stage and the download task stats
+        :rtype: the return type dict
+        """
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        threads = [threading.Thread(target=self._feed, args=(queues[0], self.stages[0].workers), daemon=True)]
+
+        for i, stage in enumerate(self.stages):
+            last = i == len(self.stages) - 1
+            outq = None if last else queues[i + 1]
+            next_workers = 0 if last else self.stages[i + 1].workers
+            stage._running = stage.workers
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(target=self._work, args=(stage, queues[i], outq, next_workers),
+                                                daemon=True))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        return {
+            'seconds': round(elapsed, 3),
+            'stages': {stage.name: stage.stats(elapsed) for stage in [self.source, self.tasks] + self.stages},
+            'tasks': self.poller.stats(),
+        }
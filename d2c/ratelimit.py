@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+from .transport import IdempotentMethods, TimeoutAdapter
+
+# Error codes from the MediaWiki API that mean "slow down".
+SlowDownCodes = ('maxlag', 'ratelimited', 'readonly')
+
+# (start, min, max) requests per second of each limiter in RateLimits.
+DefaultRates = {
+    'fotoware': (5.0, 0.2, 20.0),
+    'commons': (0.2, 1 / 60, 1.0),
+    'thumbnails': (5.0, 0.5, 20.0),
+}
+
+
+def parse_retry_after(value):
+    """
+    parse_retry_after
+    @param value: Retry-After header, either seconds or an HTTP date.
+    @type value: str
+
+    :return: return the seconds to wait, or None if the header is missing or invalid
+    :rtype: the return type float
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """
+        Thread-safe token bucket, "rate" requests per second with bursts of "burst".
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.paused_until = 0.0
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Wait until "tokens" requests may be sent.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= tokens:
+                        self.tokens -= tokens
+                        return
+                    wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Send nothing for the next "seconds".
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveLimiter(TokenBucket):
+    """
+        Token bucket with additive increase / multiplicative decrease of the rate.
+
+        Every success raises the rate by "increase" requests per second, up to "max_rate".
+        Every overload signal (HTTP 429/503, Retry-After, maxlag) multiplies it by "decrease",
+        down to "min_rate", and pauses for the time the server asked for.
+    """
+
+    def __init__(self, rate, min_rate, max_rate, increase=0.05, decrease=0.5, burst=1):
+        super().__init__(rate, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.successes = 0
+        self.failures = 0
+
+    def success(self):
+        with self._lock:
+            self.successes += 1
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def failure(self, retry_after=None):
+        """
+        failure
+        @param retry_after: Seconds the server asked us to wait. Default one request interval at the new rate.
+        @type retry_after: float
+        """
+        with self._lock:
+            self.failures += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            rate = self.rate
+        self.pause(retry_after if retry_after is not None else 1 / rate)
+
+    def observe(self, status_code, headers):
+        """
+        observe
+        @param status_code: HTTP status of a response.
+        @type status_code: int
+        @param headers: Headers of the response.
+        @type headers: dict
+        """
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+        if status_code in (429, 503) or (retry_after is not None and status_code >= 500):
+            self.failure(retry_after)
+        elif status_code < 500:
+            self.success()
+
+    def stats(self):
+        return {'rate': round(self.rate, 3), 'successes': self.successes, 'failures': self.failures}
+
+
+class RateLimits:
+    """
+        One adaptive limiter per server, shared by every thread of a Client.
+
+        Example usage:
+            limits = RateLimits(fotoware=(5, 0.2, 20), commons=(0.2, 1 / 60, 1))
+            r = d2c.Client(rate_limits=limits)
+    """
+
+    def __init__(self, fotoware=DefaultRates['fotoware'], commons=DefaultRates['commons'],
+                 thumbnails=DefaultRates['thumbnails']):
+        """
+        __init__
+        @param fotoware: (start, min, max) requests per second to foto.digitalarkivet.no.
+        @type fotoware: tuple
+        @param commons: (start, min, max) uploads per second to Wikimedia Commons.
+        @type commons: tuple
+        @param thumbnails: (start, min, max) thumbnail downloads per second from upload.wikimedia.org.
+        @type thumbnails: tuple
+        """
+        self.fotoware = AdaptiveLimiter(*fotoware)
+        self.commons = AdaptiveLimiter(*commons)
+        self.thumbnails = AdaptiveLimiter(*thumbnails)
+        # Commons API calls go through pywikibot instead
+        self.hosts = {'foto.digitalarkivet.no': self.fotoware, 'upload.wikimedia.org': self.thumbnails}
+
+    def for_url(self, url):
+        return self.hosts.get(urlparse(url).hostname)
+
+    def commons_error(self, error):
+        """
+        commons_error
+        @param error: Exception raised while uploading to Commons. The exceptions it was raised from are
+            checked too, e.g. the APIError behind a ChunkedUploadError.
+        @type error: Exception
+
+        :return: return True if the error was an overload signal and the Commons rate was lowered
+        :rtype: the return type bool
+        """
+        seen = set()
+        while error is not None and id(error) not in seen:
+            seen.add(id(error))
+            code = getattr(error, 'code', '') or ''
+            if code in SlowDownCodes or 'maxlag' in type(error).__name__.lower():
+                self.commons.failure()
+                return True
+            error = error.__cause__ or error.__context__
+        return False
+
+    def stats(self):
+        return {'fotoware': self.fotoware.stats(), 'commons': self.commons.stats(),
+                'thumbnails': self.thumbnails.stats()}
+
+
+class RateLimitedAdapter(TimeoutAdapter):
+    """
+        Transport adapter that waits for the limiter of the host before each request,
+        and tells it about overload signals in the response. An idempotent request that
+        got 429 or 503 is sent again, once the limiter allows it.
+    """
+
+    def __init__(self, limits, overload_retries=3, **kwargs):
+        self.limits = limits
+        self.overload_retries = overload_retries
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        limiter = self.limits.for_url(request.url)
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            response = super().send(request, **kwargs)
+            if limiter is None:
+                return response
+            limiter.observe(response.status_code, response.headers)
+            if (response.status_code not in (429, 503) or request.method not in IdempotentMethods
+                    or attempt >= self.overload_retries):
+                return response
+            attempt += 1
+            response.close()
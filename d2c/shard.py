@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+import os
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from .ratelimit import RateLimits
+from .state import StateStore
+
+STATE_FILE = 'state.sqlite'
+
+# The job dir can be on a network file system, where the WAL journal of SQLite does not work.
+STATE_JOURNAL = 'DELETE'
+
+
+def default_commons():
+    import pywikibot
+    return pywikibot.Site("commons", "commons")
+
+
+def _kwargs(client_args):
+    """
+    Client arguments, "rate_limits" can be a dict of RateLimits arguments so it can be sent to a worker process.
+    """
+    kwargs = dict(client_args or {})
+    if isinstance(kwargs.get('rate_limits'), dict):
+        kwargs['rate_limits'] = RateLimits(**kwargs['rate_limits'])
+    return kwargs
+
+
+def _client(job_dir, client_args):
+    from .client import Client
+    return Client(state=StateStore(os.path.join(job_dir, STATE_FILE), STATE_JOURNAL), **_kwargs(client_args))
+
+
+def list_shard(job_dir, query, urls=None, client_args=None):
+    """
+    list_shard
+    @param job_dir: Directory shared by every worker, holds the state file.
+    @type job_dir: str
+    @param query: Search term used for finding images.
+    @type query: str
+    @param urls: Pages of the result to list. Default the whole result of "query".
+    @type urls: list
+    @param client_args: Keyword arguments for the Client of the worker.
+    @type client_args: dict
+
+    :return: return the amount of image pages found
+    :rtype: the return type int
+    """
+    client = _client(job_dir, client_args)
+    if urls is None:
+        return sum(1 for _ in client.iter_query(query))
+
+    found = 0
+    for url in urls:
+        data = client._query_page(url)
+        hrefs = [ref['href'] for ref in data['data'] if ref['href'].endswith(".tif.info")]
+        client.state.add_many(hrefs, query)
+        found += len(hrefs)
+    return found
+
+
+def work(job_dir, worker=None, file_ending="tif", summary="", commons_factory=default_commons, client_args=None,
+         batch_size=4, lease=3600, preflight=True):
+    """
+    work
+    @param job_dir: Directory shared by every worker, holds the state file.
+    @type job_dir: str
+    @param worker: Name of the worker. Default host name and process id.
+    @type worker: str
+    @param file_ending: Size for the image. Most be in "Client.Size". Default "tif".
+    @type file_ending: str
+    @param summary: Upload comment for each image. Allows Wikitext. Default None.
+    @type summary: str
+    @param commons_factory: Function returning the site that is used for upload.
+    @type commons_factory: callable
+    @param client_args: Keyword arguments for the Client of the worker.
+    @type client_args: dict
+    @param batch_size: Images claimed at a time, FotoWare takes max 4 per download task.
+    @type batch_size: int
+    @param lease: Seconds before images claimed by a worker that stopped can be taken by another.
+    @type lease: float
+    @param preflight: Skip the images of each batch that are on Commons before creating its download task.
+    @type preflight: bool
+
+    :return: return the amount of image pages this worker handled
+    :rtype: the return type int
+    """
+    worker = worker or '{}:{}'.format(socket.gethostname(), os.getpid())
+    client = _client(job_dir, client_args)
+    commons = commons_factory()
+    handled = 0
+
+    while True:
+        batch = client.state.claim(worker, batch_size, lease)
+        if not batch:
+            return handled
+        try:
+            todo = client.preflight(commons, file_ending, batch) if preflight and commons is not None else batch
+            client.handle_upload(todo, commons, file_ending, summary)
+            error = "not in the result of the download task"  # Left out by FotoWare
+        except Exception as e:  # Keep going, failed images are not claimed again until their lease is over
+            print("{} failed: {}".format(worker, e))
+            error = repr(e)
+        for href in batch:
+            if client.state.status(href) in ('queried', 'downloaded', 'described'):
+                client.state.set_status(href, 'failed', error=error)
+        handled += len(batch)
+
+
+class Coordinator:
+    """
+        Splits many queries, or the pages of one large query, over several worker processes.
+
+        Every worker shares one SQLite state file in "job_dir": image pages are stored once
+        whatever query found them, a worker claims a batch before creating its download task,
+        and a Commons file name belongs to the first image that claimed it. Workers on other
+        machines can join by calling "work" with the same "job_dir" on a shared file system; the
+        state file then uses the rollback journal of SQLite, since WAL does not work over a network.
+
+        Example usage:
+            c = Coordinator(["/fotoweb/archives/5001-Historiske-foto/;o=+?q=reinbeite*",
+                             "/fotoweb/archives/5001-Historiske-foto/;o=+?q=fiske*"], "jobs/nightly", workers=4)
+            report = c.run(file_ending="tif", summary="...")
+    """
+
+    def __init__(self, queries, job_dir, workers=4, page_shards=None, client_args=None,
+                 commons_factory=default_commons, progress_interval=30, preflight=True):
+        """
+        __init__
+        @param queries: Search terms used for finding images.
+        @type queries: list
+        @param job_dir: Directory shared by every worker, created if missing.
+        @type job_dir: str
+        @param workers: Amount of worker processes on this machine.
+        @type workers: int
+        @param page_shards: Split the result pages of each query over this many listing workers, when the page
+            links are predictable. Default "workers".
+        @type page_shards: int
+        @param client_args: Keyword arguments for the Client of each worker.
+        @type client_args: dict
+        @param commons_factory: Function returning the site that is used for upload, called in each worker.
+        @type commons_factory: callable
+        @param progress_interval: Seconds between two progress lines.
+        @type progress_interval: float
+        @param preflight: Skip the images that are on Commons before creating their download task, see "work".
+        @type preflight: bool
+        """
+        self.queries = list(queries)
+        self.job_dir = job_dir
+        self.workers = workers
+        self.page_shards = page_shards or workers
+        self.client_args = client_args
+        self.commons_factory = commons_factory
+        self.progress_interval = progress_interval
+        self.preflight = preflight
+        os.makedirs(job_dir, exist_ok=True)
+        self.state = StateStore(os.path.join(job_dir, STATE_FILE), STATE_JOURNAL)
+
+    def shards(self):
+        """
+        shards
+
+        :return: return (query, urls) for every listing shard, urls None for a whole query
+        :rtype: the return type list
+        """
+        from .client import Client
+        client = Client(**_kwargs(self.client_args))
+        shards = []
+        for query in self.queries:
+            data = client._query_page(client.urlDA + query)
+            urls = client._page_urls(data) if data['paging']['next'] else None
+            if not urls or self.page_shards < 2:
+                shards.append((query, None))
+                continue
+            shards.append((query, [client.urlDA + query]))
+            size = -(-len(urls) // self.page_shards)
+            shards.extend((query, urls[i:i + size]) for i in range(0, len(urls), size))
+        return shards
+
+    def progress(self):
+        counts = self.state.counts()
+        statuses = ', '.join('{} {}'.format(n, status) for status, n in sorted(counts.items()))
+        print("progress: {} images, {}".format(sum(counts.values()), statuses))
+        return counts
+
+    def _wait(self, futures):
+        results = []
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=self.progress_interval, return_when=FIRST_COMPLETED)
+            results.extend(future.result() for future in done)
+            if pending and not done:
+                self.progress()
+        return results
+
+    def run(self, file_ending="tif", summary=""):
+        """
+        run
+        @param file_ending: Size for the image. Most be in "Client.Size". Default "tif".
+        @type file_ending: str
+        @param summary: Upload comment for each image. Allows Wikitext. Default None.
+        @type summary: str
+
+        :return: return the wall time, the amount of images per status and per worker
+        :rtype: the return type dict
+        """
+        start = time.monotonic()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            listed = self._wait([pool.submit(list_shard, self.job_dir, query, urls, self.client_args)
+                                 for query, urls in self.shards()])
+            self.progress()
+            self._wait([pool.submit(work, self.job_dir, '{}:{}'.format(socket.gethostname(), i), file_ending, summary,
+                                    self.commons_factory, self.client_args, preflight=self.preflight)
+                        for i in range(self.workers)])
+
+        print("Done")
+        return {
+            'seconds': round(time.monotonic() - start, 3),
+            'listed': sum(listed),
+            'statuses': self.progress(),
+            'workers': self.state.worker_counts(),
+        }
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+import json
+import sqlite3
+import threading
+import time
+
+# Status of an asset, in the order it moves through "Client.upload".
+Statuses = ('queried', 'downloaded', 'described', 'uploaded', 'exists', 'restricted', 'failed')
+
+# Assets with one of these statuses are not processed again.
+DoneStatuses = ('uploaded', 'exists', 'restricted')
+
+
+class StateStore:
+    """
+        Progress of every asset, kept in a SQLite file so an interrupted upload can be resumed.
+
+        Assets are keyed by their href on foto.digitalarkivet.no and hold the last stage they
+        reached, the metadata found for them, the title used on Commons and the last error.
+
+        Example usage:
+            state = StateStore("d2c-state.sqlite")
+            state.add_many(client.pages, query)
+            todo = state.pending()
+    """
+
+    def __init__(self, path, journal_mode='WAL'):
+        """
+        __init__
+        @param path: SQLite file. Created if it does not exist, ":memory:" for no file.
+        @type path: str
+        @param journal_mode: SQLite journal mode. WAL needs shared memory, so a file shared over a network file
+            system must use "DELETE", the rollback journal.
+        @type journal_mode: str
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            if path != ':memory:':
+                self._db.execute('PRAGMA journal_mode={}'.format(journal_mode))
+            self._db.execute('''CREATE TABLE IF NOT EXISTS assets (
+                                    href TEXT PRIMARY KEY,
+                                    query TEXT,
+                                    status TEXT NOT NULL,
+                                    commons_data TEXT,
+                                    title TEXT,
+                                    error TEXT,
+                                    updated REAL)''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS assets_status ON assets (status)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS assets_title ON assets (title)')
+            columns = {row['name'] for row in self._db.execute('PRAGMA table_info(assets)')}
+            for column, kind in (('worker', 'TEXT'), ('claimed', 'REAL')):  # Added for sharded runs
+                if column not in columns:
+                    self._db.execute('ALTER TABLE assets ADD COLUMN {} {}'.format(column, kind))
+            self._db.execute('''CREATE TABLE IF NOT EXISTS titles (
+                                    title TEXT PRIMARY KEY,
+                                    href TEXT NOT NULL)''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS queries (
+                                    query TEXT PRIMARY KEY,
+                                    etag TEXT,
+                                    last_modified TEXT,
+                                    modified TEXT,
+                                    updated REAL)''')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def add_many(self, hrefs, query=None):
+        """
+        add_many
+        @param hrefs: Image pages from a query. Already known pages keep their status.
+        @type hrefs: iterable
+        @param query: Search term the pages were found with.
+        @type query: str
+
+        :return: return the amount of new pages
+        :rtype: the return type int
+        """
+        now = time.time()
+        with self._lock, self._db:
+            before = self._db.total_changes
+            self._db.executemany('INSERT OR IGNORE INTO assets (href, query, status, updated) VALUES (?, ?, ?, ?)',
+                                 ((href, query, 'queried', now) for href in hrefs))
+            return self._db.total_changes - before
+
+    def set_status(self, href, status, commons_data=None, title=None, error=None):
+        """
+        set_status
+        @param href: Image page on foto.digitalarkivet.no.
+        @type href: str
+        @param status: New status, one of "Statuses".
+        @type status: str
+        @param commons_data: Metadata of the image, kept if not given.
+        @type commons_data: dict
+        @param title: File name on Commons, kept if not given.
+        @type title: str
+        @param error: Error message, cleared if not given.
+        @type error: str
+        """
+        if status not in Statuses:
+            raise TypeError(
+                f"Status, {status}, is out of the scope"
+            )
+        data = json.dumps(commons_data) if commons_data is not None else None
+        with self._lock, self._db:
+            self._db.execute('''INSERT INTO assets (href, status, commons_data, title, error, updated)
+                                VALUES (?, ?, ?, ?, ?, ?)
+                                ON CONFLICT (href) DO UPDATE SET
+                                    status = excluded.status,
+                                    commons_data = COALESCE(excluded.commons_data, commons_data),
+                                    title = COALESCE(excluded.title, title),
+                                    error = excluded.error,
+                                    updated = excluded.updated''',
+                             (href, status, data, title, error, time.time()))
+
+    def get(self, href):
+        """
+        get
+        @param href: Image page on foto.digitalarkivet.no.
+        @type href: str
+
+        :return: return the stored row with "commons_data" decoded, or None if the page is unknown
+        :rtype: the return type dict
+        """
+        with self._lock:
+            row = self._db.execute('SELECT * FROM assets WHERE href = ?', (href,)).fetchone()
+        if row is None:
+            return None
+        row = dict(row)
+        row['commons_data'] = json.loads(row['commons_data']) if row['commons_data'] else None
+        return row
+
+    def known(self, hrefs):
+        """
+        known
+        @param hrefs: Image pages on foto.digitalarkivet.no.
+        @type hrefs: list
+
+        :return: return the pages that are already stored
+        :rtype: the return type set
+        """
+        found = set()
+        hrefs = list(hrefs)
+        with self._lock:
+            for i in range(0, len(hrefs), 500):  # Stay below the SQLite limit of bound variables
+                batch = hrefs[i:i + 500]
+                rows = self._db.execute('SELECT href FROM assets WHERE href IN ({})'.format(','.join('?' * len(batch))),
+                                        batch)
+                found.update(row['href'] for row in rows)
+        return found
+
+    def watermark(self, query):
+        """
+        watermark
+        @param query: Search term used for finding images.
+        @type query: str
+
+        :return: return the ETag, Last-Modified and newest asset modification time seen at the last complete run
+            of the query, or None if it never ran
+        :rtype: the return type dict
+        """
+        with self._lock:
+            row = self._db.execute('SELECT etag, last_modified, modified FROM queries WHERE query = ?',
+                                   (query,)).fetchone()
+        return dict(row) if row else None
+
+    def set_watermark(self, query, etag=None, last_modified=None, modified=None):
+        """
+        set_watermark
+        @param query: Search term used for finding images.
+        @type query: str
+        @param etag: ETag header of the first page of the result.
+        @type etag: str
+        @param last_modified: Last-Modified header of the first page of the result.
+        @type last_modified: str
+        @param modified: Newest "modified" time of the assets in the result.
+        @type modified: str
+        """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO queries (query, etag, last_modified, modified, updated) '
+                             'VALUES (?, ?, ?, ?, ?)', (query, etag, last_modified, modified, time.time()))
+
+    def claim(self, worker, limit=4, lease=3600):
+        """
+        claim
+        @param worker: Name of the worker taking the pages.
+        @type worker: str
+        @param limit: Max amount of pages to take.
+        @type limit: int
+        @param lease: Seconds before pages claimed by a worker that did not finish them can be taken again.
+        @type lease: float
+
+        :return: return pages no other worker holds, now held by "worker". Failed pages are taken again once
+            their lease is over, so each one is tried again at most once per lease.
+        :rtype: the return type list
+        """
+        now = time.time()
+        with self._lock:
+            try:
+                self._db.execute('BEGIN IMMEDIATE')  # Lock the file so two processes never take the same page
+                rows = self._db.execute('SELECT href FROM assets WHERE status IN (?, ?, ?, ?) '
+                                        'AND (claimed IS NULL OR claimed < ?) ORDER BY rowid LIMIT ?',
+                                        ('queried', 'downloaded', 'described', 'failed', now - lease,
+                                         limit)).fetchall()
+                hrefs = [row['href'] for row in rows]
+                self._db.executemany('UPDATE assets SET worker = ?, claimed = ? WHERE href = ?',
+                                     ((worker, now, href) for href in hrefs))
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+        return hrefs
+
+    def claim_title(self, title, href):
+        """
+        claim_title
+        @param title: File name on Commons.
+        @type title: str
+        @param href: Image page that wants to use the name.
+        @type href: str
+
+        :return: return True if the name is free or already belongs to "href"
+        :rtype: the return type bool
+        """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR IGNORE INTO titles (title, href) VALUES (?, ?)', (title, href))
+            row = self._db.execute('SELECT href FROM titles WHERE title = ?', (title,)).fetchone()
+        return row['href'] == href
+
+    def worker_counts(self):
+        """
+        worker_counts
+
+        :return: return the amount of pages for each worker and status
+        :rtype: the return type dict
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT worker, status, COUNT(*) AS n FROM assets WHERE worker IS NOT NULL '
+                                    'GROUP BY worker, status').fetchall()
+        counts = {}
+        for row in rows:
+            counts.setdefault(row['worker'], {})[row['status']] = row['n']
+        return counts
+
+    def status(self, href):
+        row = self.get(href)
+        return row['status'] if row else None
+
+    def is_done(self, href):
+        return self.status(href) in DoneStatuses
+
+    def has_title(self, title):
+        """
+        has_title
+        @param title: File name on Commons.
+        @type title: str
+
+        :return: return True if an asset was uploaded or found under this name
+        :rtype: the return type bool
+        """
+        with self._lock:
+            row = self._db.execute('SELECT 1 FROM assets WHERE title = ? AND status IN (?, ?)',
+                                   (title, 'uploaded', 'exists')).fetchone()
+        return row is not None
+
+    def pending(self, hrefs=None, query=None):
+        """
+        pending
+        @param hrefs: Only check these pages. Default every stored page.
+        @type hrefs: iterable
+        @param query: Only stored pages found with this search term, when "hrefs" is not given.
+        @type query: str
+
+        :return: return the pages that are not done, in the order they were added
+        :rtype: the return type list
+        """
+        with self._lock:
+            if hrefs is None and query is not None:
+                rows = self._db.execute('SELECT href FROM assets WHERE query = ? AND status NOT IN (?, ?, ?) '
+                                        'ORDER BY rowid', (query,) + DoneStatuses).fetchall()
+                return [row['href'] for row in rows]
+            if hrefs is None:
+                rows = self._db.execute('SELECT href FROM assets WHERE status NOT IN (?, ?, ?) ORDER BY rowid',
+                                        DoneStatuses).fetchall()
+                return [row['href'] for row in rows]
+            hrefs = list(hrefs)
+            done = set()
+            for i in range(0, len(hrefs), 500):  # Stay below the SQLite limit of bound variables
+                batch = hrefs[i:i + 500]
+                rows = self._db.execute('SELECT href FROM assets WHERE href IN ({}) AND status IN (?, ?, ?)'.format(
+                    ','.join('?' * len(batch))), batch + list(DoneStatuses))
+                done.update(row['href'] for row in rows)
+        return [href for href in hrefs if href not in done]
+
+    def counts(self):
+        """
+        counts
+
+        :return: return the amount of pages for each status
+        :rtype: the return type dict
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT status, COUNT(*) AS n FROM assets GROUP BY status').fetchall()
+        return {row['status']: row['n'] for row in rows}
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import heapq
+import itertools
+import random
+import time
+
+FailedStatuses = ('failed', 'error', 'aborted', 'canceled', 'cancelled')
+
+
+class Backoff:
+    """
+        Exponential backoff with jitter between polls of one background task.
+    """
+
+    def __init__(self, min_delay=0.25, max_delay=10.0, factor=1.5, jitter=0.25):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """
+        delay
+        @param attempt: Amount of polls already done for the task.
+        @type attempt: int
+
+        :return: return the seconds to wait before the next poll
+        :rtype: the return type float
+        """
+        delay = min(self.max_delay, self.min_delay * self.factor ** attempt)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class Job:
+    """
+        One background download task and the images it was created for.
+    """
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.location = None
+        self.error = None
+        self.submitted = 0.0
+        self.polls = 0
+        self.attempts = 0
+        self.resubmit = False
+
+
+class TaskPoller:
+    """
+        Keeps several FotoWare background download tasks in flight and polls all of
+        them from one loop, yielding the files of each task as soon as it is done.
+
+        Example usage:
+            poller = TaskPoller(client, client.Size['tif'], in_flight=8)
+            for img in poller.run(client.pages):
+                meta = client.get_metadata(img['src'], img['href'], 'tif')
+            print(poller.stats())
+    """
+
+    def __init__(self, client, size, in_flight=4, batch_size=4, timeout=300, retries=2, backoff=None, record=True,
+                 retry_backoff=None):
+        """
+        __init__
+        @param client: Client used for every request.
+        @type client: d2c.Client
+        @param size: Size for the image. Most be in "client.Size".
+        @type size: str
+        @param in_flight: Max amount of tasks waiting on the server at the same time.
+        @type in_flight: int
+        @param batch_size: Images per task, FotoWare takes max 4.
+        @type batch_size: int
+        @param timeout: Seconds before a task that is not done is given up on.
+        @type timeout: float
+        @param retries: Amount of times a failed or timed out task is created again.
+        @type retries: int
+        @param backoff: Delay between polls of one task. Default "Backoff()".
+        @type backoff: Backoff
+        @param record: Record the finished files as "downloaded" in the state of "client".
+        @type record: bool
+        @param retry_backoff: Delay before a failed or timed out task is created again. Default
+            "Backoff(2.0, 60.0, 3.0)".
+        @type retry_backoff: Backoff
+        """
+        self.client = client
+        self.size = size
+        self.in_flight = in_flight
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff or Backoff()
+        self.retry_backoff = retry_backoff or Backoff(2.0, 60.0, 3.0)
+        self.record = record
+        self.latencies = []
+        self.polls = 0
+        self.retried = 0
+        self.failed = []
+
+    def _batches(self, pages):
+        batch = []
+        for page in pages:
+            batch.append(page)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _submit(self, job):
+        job.submitted = time.monotonic()
+        job.polls = 0
+        job.attempts += 1
+        try:
+            job.location = self.client._post(job.batch, self.size)
+            job.error = None
+        except Exception as e:  # Created again by "_retry" like a failed task
+            job.location = None
+            job.error = e
+
+    def _retry(self, job, reason, waiting, order):
+        if job.attempts <= self.retries:
+            self.retried += 1
+            self.client.metrics.incr('task_retries')
+            limiter = self.client.rate_limits.for_url(self.client.urlDA)
+            if limiter is not None:  # A task FotoWare could not finish is an overload signal too
+                limiter.failure()
+            job.resubmit = True  # Created again by "run" once the delay is over
+            heapq.heappush(waiting, (time.monotonic() + self.retry_backoff.delay(job.attempts - 1), next(order), job))
+        else:
+            print("download task failed ({}): {}".format(reason, ', '.join(job.batch)))
+            self.failed.append((job.batch, reason))
+            self.client.metrics.incr('failed_tasks')
+
+    def run(self, pages):
+        """
+        run
+        @param pages: Image pages to create download tasks for.
+        @type pages: iterable
+
+        :return: yields the files of each finished task, same dicts as in "result['files']"
+        :rtype: the return type generator
+        """
+        batches = self._batches(pages)
+        waiting = []  # heap of (next poll time, tie breaker, job)
+        order = itertools.count()
+
+        while True:
+            while len(waiting) < self.in_flight:  # Keep the pipe full
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                job = Job(batch)
+                self._submit(job)
+                heapq.heappush(waiting, (time.monotonic() + self.backoff.delay(0), next(order), job))
+
+            if not waiting:
+                break
+
+            due, _, job = heapq.heappop(waiting)
+            pause = due - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+
+            if job.resubmit:
+                job.resubmit = False
+                self._submit(job)
+                heapq.heappush(waiting, (time.monotonic() + self.backoff.delay(0), next(order), job))
+                continue
+
+            if not job.location:
+                self._retry(job, repr(job.error) if job.error else "no task location", waiting, order)
+                continue
+
+            try:
+                data = self.client._status(job.location)
+            except Exception as e:  # Polled again, until the task times out
+                print("polling {} failed: {}".format(job.location, e))
+                data = None
+            self.polls += 1
+            job.polls += 1
+            status = data['job']['status'] if data and 'job' in data else ''
+
+            if status == 'done':
+                self.latencies.append(time.monotonic() - job.submitted)
+                self.client.metrics.add('task_wait', self.latencies[-1])
+                for img in data['job']['result']['files'] if self.record else ():
+                    self.client._record(img['src'], 'downloaded')
+                yield from data['job']['result']['files']
+            elif status in FailedStatuses:
+                self._retry(job, status, waiting, order)
+            elif time.monotonic() - job.submitted > self.timeout:
+                self._retry(job, "timeout", waiting, order)
+            else:
+                heapq.heappush(waiting, (time.monotonic() + self.backoff.delay(job.polls), next(order), job))
+
+    def stats(self):
+        """
+        stats
+
+        :return: return the amount of tasks, polls, retries and failures, and the task latency in seconds
+        :rtype: the return type dict
+        """
+        latencies = sorted(self.latencies)
+        return {
+            'done': len(latencies),
+            'failed': len(self.failed),
+            'retried': self.retried,
+            'polls': self.polls,
+            'polls_per_task': round(self.polls / len(latencies), 2) if latencies else 0.0,
+            'latency_mean': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            'latency_p50': round(latencies[len(latencies) // 2], 3) if latencies else 0.0,
+            'latency_max': round(latencies[-1], 3) if latencies else 0.0,
+        }
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) seconds, used when a request does not set its own timeout.
+DefaultTimeout = (10, 120)
+
+# Sent again after a dropped connection or a 5xx answer. POST only when the connection failed before sending.
+IdempotentMethods = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+
+# 429 and 503 are left to the rate limiter, which slows down and honours Retry-After.
+RetryStatuses = (500, 502, 504)
+
+
+def retry_policy(retries=3, backoff_factor=0.5):
+    """
+    retry_policy
+    @param retries: Amount of times one request is sent again.
+    @type retries: int
+    @param backoff_factor: Seconds before the first retry, doubled for each next one.
+    @type backoff_factor: float
+
+    :return: return the urllib3 retry policy for the adapters
+    :rtype: the return type Retry
+    """
+    # Retry-After is left to the rate limiter too, else urllib3 would retry 429/503 answers that carry it
+    return Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff_factor,
+                 status_forcelist=RetryStatuses, allowed_methods=IdempotentMethods, raise_on_status=False,
+                 respect_retry_after_header=False)
+
+
+class TimeoutAdapter(HTTPAdapter):
+    """
+        HTTPAdapter with a default timeout, so no request can hang forever.
+    """
+
+    def __init__(self, timeout=DefaultTimeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=self.timeout if timeout is None else timeout, **kwargs)
+
+
+class Transport:
+    """
+        Connection pools, timeouts, retries and sessions shared by every thread of a Client.
+
+        Each thread gets its own requests.Session, since a session is not safe to share between
+        threads, but all of them use the same adapters (one connection pool per host, sized for
+        the amount of workers) and the same cookies, so a download task made in one thread can be
+        polled from another. Every session asks for gzip and keeps connections alive.
+
+        Example usage:
+            t = Transport(pool_size=32, timeout=(5, 60), retries=5)
+            r = d2c.Client(transport=t)
+    """
+
+    def __init__(self, pool_size=16, timeout=DefaultTimeout, retries=3, backoff_factor=0.5, user_agent=None,
+                 session=None):
+        """
+        __init__
+        @param pool_size: Max open connections per host, at least the amount of threads making requests.
+        @type pool_size: int
+        @param timeout: Seconds to connect and to wait for data, a number or a (connect, read) tuple.
+        @type timeout: tuple
+        @param retries: Amount of times an idempotent request is sent again after a dropped connection or
+            a 500/502/504 answer.
+        @type retries: int
+        @param backoff_factor: Seconds before the first retry, doubled for each next one.
+        @type backoff_factor: float
+        @param user_agent: User-Agent header of every request.
+        @type user_agent: str
+        @param session: Session used by every thread instead of one session per thread.
+        @type session: requests.Session
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.headers = {'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'}
+        if user_agent:
+            self.headers['User-Agent'] = user_agent
+        self.cookies = session.cookies if session is not None else requests.cookies.RequestsCookieJar()
+        self.mounts = {}
+        self._shared = session
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sessions = weakref.WeakSet()  # A thread's session goes away with the thread
+        default = self.adapter()
+        self.mount('https://', default)
+        self.mount('http://', default)
+        if session is not None:
+            self._setup(session)
+
+    def adapter(self, cls=TimeoutAdapter, **kwargs):
+        """
+        adapter
+        @param cls: TimeoutAdapter or a subclass of it.
+        @type cls: type
+        @param kwargs: More arguments for "cls".
+        @type kwargs: dict
+
+        :return: return an adapter with the pool size, timeout and retry policy of this transport
+        :rtype: the return type TimeoutAdapter
+        """
+        return cls(timeout=self.timeout, pool_connections=self.pool_size, pool_maxsize=self.pool_size,
+                   max_retries=retry_policy(self.retries, self.backoff_factor), **kwargs)
+
+    def mount(self, prefix, adapter):
+        """
+        Use "adapter" for every URL starting with "prefix", in every session made before and after.
+        """
+        with self._lock:
+            self.mounts[prefix] = adapter
+            sessions = list(self._sessions)
+        for session in sessions:
+            session.mount(prefix, adapter)
+
+    def _setup(self, session):
+        session.headers.update(self.headers)
+        session.cookies = self.cookies
+        with self._lock:
+            mounts = dict(self.mounts)
+            self._sessions.add(session)
+        for prefix, adapter in mounts.items():
+            session.mount(prefix, adapter)
+        return session
+
+    @property
+    def session(self):
+        """
+        The session of the calling thread.
+        """
+        if self._shared is not None:
+            return self._shared
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._setup(requests.Session())
+        return session
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = list(self._sessions), weakref.WeakSet()
+            adapters = list(self.mounts.values())
+        for session in sessions:
+            session.close()
+        for adapter in adapters:
+            adapter.close()
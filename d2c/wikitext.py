@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+import json
+from functools import lru_cache
+from string import Template
+
+import dateutil.parser as parser
+
+CountryNames = {
+    'norge': 'Norway',
+    'sverige': 'Sweden',
+    'finland': 'Finland',
+    'danmark': 'Denmark',
+    'ukjent land': '',
+}
+
+# Values that mean "unknown", the country also has its own.
+UnknownPlaces = ('ukjent',)
+UnknownCountries = ('ukjent', 'ukjent land')
+
+Licenses = {
+    'falt i det fri': "{{PD-Norway50}}",
+    'cc0': "{{CC0}}",
+    'cc-0': "{{CC0}}",
+    'cc-by': "{{CC BY 4.0}}",
+    'cc by': "{{CC BY 4.0}}",
+    'cc-by-sa': "{{CC BY-SA 4.0}}",
+    'cc by-sa': "{{CC BY-SA 4.0}}",
+}
+
+# Compiled once, "$" placeholders so the wikitext braces need no escaping.
+Description = Template('''=={{int:filedesc}}==
+{{Photograph
+|description        = {{nb|1= Bildet er hentet fra Arkivverket.<br/>
+${desc}}}
+|title              = ${title}
+${depicted_place}${date}|institution        = ${institution}
+|department         = {{institution:Arkivverket}}
+|accession number   = ${accession}
+|notes              = {{nb | 1 = ${notes} }}
+${object_history}|source             = [${source} foto.digitalarkivet.no]
+${photographer}
+|depicted people    =
+|permission         =
+|other_versions     =
+|wikidata           =
+|camera coord       =
+}}
+
+=={{int:license-header}}==
+${licenses}${category}${year_category}''')
+
+
+@lru_cache(maxsize=65536)
+def iso_date(value):
+    """
+    iso_date
+    @param value: "DateCreated" of an image, a year or a full date.
+    @type value: str
+
+    :return: return the date as YYYY-MM-DD, a year or anything that can not be parsed as it is
+    :rtype: the return type str
+    """
+    if len(value) <= 4:
+        return value
+    try:
+        return parser.parse(value).isoformat()[0:10]
+    except (ValueError, OverflowError):
+        return value
+
+
+@lru_cache(maxsize=65536)
+def creator_name(name):
+    """
+    creator_name
+    @param name: Creator as "Last, First".
+    @type name: str
+
+    :return: return the creator as " First Last", or the Commons creator template of known photographers
+    :rtype: the return type str
+    """
+    last, sep, first = name.partition(',')
+    if not sep:
+        return name
+    first = first.split(',')[0]
+    if (first + ' ' + last).lower() == " jens holmboe":
+        return "{{Creator:Jens Holmboe (botanist)}}"
+    return '{} {}'.format(first, last)
+
+
+def place(value, unknown=UnknownPlaces):
+    return '' if value.lower() in unknown else value
+
+
+def file_name(metadata, file_ending):
+    """
+    file_name
+    @param metadata: All of the choosen metadata from the image.
+    @type metadata: dict
+    @param file_ending: File extension including the dot, e.g. ".tif".
+    @type file_ending: str
+
+    :return: return the file name used on Commons, without the "File:" prefix
+    :rtype: the return type str
+    """
+    if metadata['title'] == "":
+        return '{}{}'.format(metadata['digitalarkivetName'], file_ending).strip()
+    return '{} ({}){}'.format(metadata['title'], metadata['digitalarkivetName'], file_ending).strip()
+
+
+class Renderer:
+    """
+        Builds the Commons file name and "{{Photograph}}" description of an image.
+
+        The metadata dict is only read, so the same metadata can be rendered any number
+        of times. Dates, creators and licenses are normalised once per distinct value.
+
+        Example usage:
+            renderer = Renderer()
+            use_filename, description = renderer.render(metadata, ".tif")
+            renderer.dry_run(metas, "review.jsonl", ".tif")
+    """
+
+    def __init__(self, licenses=None):
+        """
+        __init__
+        @param licenses: Commons license template for each lower case "rights" value. Default "Licenses".
+        @type licenses: dict
+        """
+        self.licenses = Licenses if licenses is None else licenses
+        self._license_text = {}
+
+    def _licenses(self, rights):
+        rights = tuple(rights)
+        text = self._license_text.get(rights)
+        if text is None:
+            text = ''.join(self.licenses[right.lower()] for right in rights if right.lower() in self.licenses)
+            self._license_text[rights] = text
+        return text
+
+    def description(self, metadata):
+        """
+        description
+        @param metadata: All of the choosen metadata from the image.
+        @type metadata: dict
+
+        :return: return the wikitext of the file page
+        :rtype: the return type str
+        """
+        country = place(metadata['Country'], UnknownCountries)
+        depicted_place = ', '.join(filter(None, [place(metadata['City']), place(metadata['State']), country]))
+        date = iso_date(metadata['DateCreated']) if metadata['DateCreated'] else ''
+
+        creators = metadata['creator']
+        if creators and 'Ukjent' in creators:
+            photographer = '|photographer       = {{creator:unknown}}'
+        else:
+            photographer = '|photographer       = ' + ', '.join(filter(None, map(creator_name, creators)))
+
+        keywords = metadata['keywords'][:1] + [keyword.lower() for keyword in metadata['keywords'][1:]]
+        archive = metadata.get('CustomField18')
+        country_name = CountryNames.get(country.lower(), '') if country else ''
+
+        return Description.substitute(
+            desc=metadata['desc'],
+            title=metadata['title'],
+            depicted_place='|depicted place     = {{nb | 1 = ' + depicted_place + ' }}\n' if depicted_place
+            else '|depicted place     = \n',
+            date='|date               = {{ISOdate|' + date + '}}\n' if date else '|date               = \n',
+            institution=metadata['CustomField17'],
+            accession=metadata['IF22a_aksesjonsnummer'],
+            notes=', '.join(filter(None, keywords)),
+            object_history='|object history     = {{nb | 1 = ' + archive + ' }}\n' if archive is not None
+            else '|object history     = ',
+            source=metadata['source'],
+            photographer=photographer,
+            licenses=self._licenses(metadata['rights']),
+            category='[[Category:{} (Arkivverket)]]\n'.format(archive) if archive
+            else '[[Category:Media from the National Archives of Norway]] ',
+            year_category='[[Category:{} in {}]]'.format(date[0:4], country_name) if date and country_name else '',
+        )
+
+    def render(self, metadata, file_ending=".tif"):
+        """
+        render
+        @param metadata: All of the choosen metadata from the image.
+        @type metadata: dict
+        @param file_ending: File extension including the dot, e.g. ".tif".
+        @type file_ending: str
+
+        :return: return the file name on Commons and the wikitext of the file page
+        :rtype: the return type tuple
+        """
+        return file_name(metadata, file_ending), self.description(metadata)
+
+    def render_many(self, metas, file_ending=".tif"):
+        """
+        render_many
+        @param metas: Metadata of each image.
+        @type metas: iterable
+        @param file_ending: File extension including the dot, e.g. ".tif".
+        @type file_ending: str
+
+        :return: yields (metadata, file name, wikitext) for every image
+        :rtype: the return type generator
+        """
+        for metadata in metas:
+            yield (metadata,) + self.render(metadata, file_ending)
+
+    def dry_run(self, metas, path, file_ending=".tif"):
+        """
+        dry_run
+        @param metas: Metadata of each image.
+        @type metas: iterable
+        @param path: JSON lines file written with the source, file name and wikitext of every image.
+        @type path: str
+        @param file_ending: File extension including the dot, e.g. ".tif".
+        @type file_ending: str
+
+        :return: return the amount of images written
+        :rtype: the return type int
+        """
+        written = 0
+        with open(path, 'w', encoding='utf-8') as f:
+            for metadata, use_filename, description in self.render_many(metas, file_ending):
+                f.write(json.dumps({
+                    'source': metadata['source'],
+                    'filename': use_filename,
+                    'restricted': metadata['UserDefined233'].lower() == 'ja',
+                    'wikitext': description,
+                    'metadata_source': metadata.get('metadata_source'),
+                }, ensure_ascii=False) + '\n')
+                written += 1
+        return written
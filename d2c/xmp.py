@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+import struct
+import xml.etree.ElementTree as ET
+
+XMP_TAG = 700  # TIFF tag holding the XMP packet
+XMP_APP1_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'  # JPEG APP1 identifier for XMP
+
+# Size in bytes of the TIFF field types, used to find the length of tag 700.
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+
+
+class RemoteFile:
+    """
+        Read-only view of a file on a web server, read with HTTP Range requests.
+
+        Only the blocks that are asked for are downloaded. If the server ignores the
+        Range header the response is streamed instead, and never more than "max_bytes"
+        is kept in memory.
+    """
+
+    def __init__(self, session, url, block_size=65536, max_bytes=8 * 1024 * 1024):
+        self._S = session
+        self.url = url
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.ranged = None  # None until the first response tells us if Range is supported
+        self.size = None
+        self.bytes_transferred = 0
+        self._blocks = {}
+        self._buffer = bytearray()
+        self._response = None
+        self._stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+            self._stream = None
+
+    def read(self, offset, length):
+        """
+        read
+        @param offset: Position in the remote file to read from.
+        @type offset: int
+        @param length: Amount of bytes to read.
+        @type length: int
+
+        :return: return the bytes, shorter than "length" at the end of the file
+        :rtype: the return type bytes
+        """
+        if length <= 0:
+            return b''
+        if self.ranged is False:
+            return self._read_stream(offset, length)
+
+        first = offset // self.block_size
+        last = (offset + length - 1) // self.block_size
+        missing = [idx for idx in range(first, last + 1) if idx not in self._blocks]
+        if missing and not self._fetch_blocks(missing[0], missing[-1]):
+            return self._read_stream(offset, length)
+
+        data = bytearray()
+        for idx in range(first, last + 1):
+            block = self._blocks.get(idx, b'')
+            data += block
+            if len(block) < self.block_size:  # end of file
+                break
+        start = offset - first * self.block_size
+        return bytes(data[start:start + length])
+
+    def _fetch_blocks(self, first, last):
+        """
+        Download the blocks "first" to "last" with one Range request.
+
+        :return: return False if the server ignored the Range header
+        :rtype: the return type bool
+        """
+        start = first * self.block_size
+        end = (last + 1) * self.block_size - 1
+        if self.size is not None:
+            end = min(end, self.size - 1)
+        if self.size is not None and start >= self.size:
+            return True
+        if self.bytes_transferred + end - start + 1 > self.max_bytes:
+            raise ValueError(
+                f"Refusing to download more than {self.max_bytes} bytes of {self.url}"
+            )
+
+        headers = {'Range': 'bytes={}-{}'.format(start, end),
+                   'Accept-Encoding': 'identity'}  # Byte ranges of the file itself, not of a compressed body
+        response = self._S.get(self.url, headers=headers, stream=True)
+        if response.status_code == 416:  # Range not satisfiable, we are past the end of the file
+            response.close()
+            return True
+        if response.status_code == 200:  # Range ignored, fall back to a streamed read
+            self.ranged = False
+            self._response = response
+            self._stream = response.iter_content(self.block_size)
+            return False
+        response.raise_for_status()
+
+        self.ranged = True
+        content_range = response.headers.get('Content-Range', '')
+        if '/' in content_range and content_range.rsplit('/', 1)[1].isdigit():
+            self.size = int(content_range.rsplit('/', 1)[1])
+        data = response.content
+        self.bytes_transferred += len(data)
+        for idx in range(first, last + 1):
+            pos = (idx - first) * self.block_size
+            self._blocks[idx] = data[pos:pos + self.block_size]
+        return True
+
+    def _read_stream(self, offset, length):
+        need = offset + length
+        if need > self.max_bytes:
+            raise ValueError(
+                f"Refusing to buffer more than {self.max_bytes} bytes of {self.url}"
+            )
+        while len(self._buffer) < need and self._stream is not None:
+            chunk = next(self._stream, None)
+            if chunk is None:
+                self.close()
+                break
+            self._buffer += chunk
+            self.bytes_transferred += len(chunk)
+        return bytes(self._buffer[offset:need])
+
+
+def _unpack(fmt, data):
+    if len(data) < struct.calcsize(fmt):
+        raise ValueError("Unexpected end of file while reading image header")
+    return struct.unpack(fmt, data[:struct.calcsize(fmt)])
+
+
+def tiff_xmp(f):
+    """
+    tiff_xmp
+    @param f: Remote TIFF file.
+    @type f: RemoteFile
+
+    :return: return the XMP packet from tag 700, or None if the image has none
+    :rtype: the return type bytes
+    """
+    head = f.read(0, 16)
+    if head[:2] == b'II':
+        bo = '<'
+    elif head[:2] == b'MM':
+        bo = '>'
+    else:
+        raise ValueError("Not a TIFF file: {}".format(f.url))
+
+    magic = _unpack(bo + 'H', head[2:4])[0]
+    if magic == 42:  # Classic TIFF
+        count_fmt, off_fmt, entry_size = 'H', 'I', 12
+        offset = _unpack(bo + 'I', head[4:8])[0]
+    elif magic == 43:  # BigTIFF
+        count_fmt, off_fmt, entry_size = 'Q', 'Q', 20
+        offset = _unpack(bo + 'Q', head[8:16])[0]
+    else:
+        raise ValueError("Not a TIFF file: {}".format(f.url))
+
+    count_size = struct.calcsize(count_fmt)
+    off_size = struct.calcsize(off_fmt)
+    seen = set()
+
+    while offset and offset not in seen:  # Walk the IFD chain
+        seen.add(offset)
+        entries = _unpack(bo + count_fmt, f.read(offset, count_size))[0]
+        ifd = f.read(offset + count_size, entries * entry_size + off_size)
+
+        for i in range(entries):
+            entry = ifd[i * entry_size:(i + 1) * entry_size]
+            tag, field_type = _unpack(bo + 'HH', entry[:4])
+            if tag != XMP_TAG:
+                continue
+            count = _unpack(bo + off_fmt, entry[4:4 + off_size])[0]
+            size = count * TIFF_TYPE_SIZES.get(field_type, 1)
+            value = entry[4 + off_size:4 + 2 * off_size]
+            if size <= off_size:  # Value stored inside the entry itself
+                return value[:size]
+            return f.read(_unpack(bo + off_fmt, value)[0], size)
+
+        offset = _unpack(bo + off_fmt, ifd[entries * entry_size:])[0]
+
+    return None
+
+
+def jpeg_xmp(f):
+    """
+    jpeg_xmp
+    @param f: Remote JPEG file.
+    @type f: RemoteFile
+
+    :return: return the XMP packet from the APP1 segment, or None if the image has none
+    :rtype: the return type bytes
+    """
+    if f.read(0, 2) != b'\xff\xd8':
+        raise ValueError("Not a JPEG file: {}".format(f.url))
+
+    pos = 2
+    while True:
+        marker = f.read(pos, 4)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        if code in (0xD9, 0xDA):  # EOI or SOS, no more metadata segments
+            return None
+        if code == 0x01 or 0xD0 <= code <= 0xD7:  # Markers without a length
+            pos += 2
+            continue
+
+        length = _unpack('>H', marker[2:4])[0]
+        if code == 0xE1 and f.read(pos + 4, len(XMP_APP1_HEADER)) == XMP_APP1_HEADER:
+            return f.read(pos + 4 + len(XMP_APP1_HEADER), length - 2 - len(XMP_APP1_HEADER))
+        pos += 2 + length
+
+
+def fetch_xmp(session, url, file_ending, block_size=65536, max_bytes=8 * 1024 * 1024, metrics=None):
+    """
+    fetch_xmp
+    @param session: Session used for the requests.
+    @type session: requests.Session
+    @param url: Image download link.
+    @type url: str
+    @param file_ending: Type of image file. Valid options: tif, small_jpg or big_jpg.
+    @type file_ending: str
+    @param block_size: Bytes fetched per Range request.
+    @type block_size: int
+    @param max_bytes: Max amount of bytes read from the image before giving up.
+    @type max_bytes: int
+    @param metrics: Counts the bytes and requests used. Default not counted.
+    @type metrics: d2c.metrics.Metrics
+
+    :return: return the XMP packet, or None if the image has none
+    :rtype: the return type bytes
+    """
+    with RemoteFile(session, url, block_size, max_bytes) as f:
+        if file_ending == "tif":
+            packet = tiff_xmp(f)
+        elif file_ending == "small_jpg" or file_ending == "big_jpg":
+            packet = jpeg_xmp(f)
+        else:
+            raise TypeError(
+                f"File type, {file_ending}, is out of the scope"
+            )
+    if metrics is not None:
+        metrics.incr('bytes_xmp', f.bytes_transferred)
+        metrics.incr('xmp_ranged' if f.ranged else 'xmp_streamed')
+
+    return packet.rstrip(b'\x00') if packet else packet
+
+
+Namespaces = {'x': 'adobe:ns:meta/',
+              'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+              'dc': 'http://purl.org/dc/elements/1.1/',
+              'fwc': 'http://ns.fotoware.com/iptcxmp-custom/1.0/',
+              'fwu': 'http://ns.fotoware.com/iptcxmp-user/1.0/',
+              'photoshop': "http://ns.adobe.com/photoshop/1.0/",
+              'xmpRights': "http://ns.adobe.com/xap/1.0/rights/"}
+
+
+def _qname(prefix, name):
+    return '{' + Namespaces[prefix] + '}' + name
+
+
+RDF_TAG = _qname('rdf', 'RDF')
+DESCRIPTION_TAG = _qname('rdf', 'Description')
+LI_TAG = _qname('rdf', 'li')
+
+# Property of rdf:Description -> (list it is collected in, rdf container holding the values)
+ListProperties = {
+    _qname('dc', 'subject'): ('keywords', _qname('rdf', 'Bag')),
+    _qname('dc', 'title'): ('title', _qname('rdf', 'Alt')),
+    _qname('dc', 'creator'): ('creator', _qname('rdf', 'Seq')),
+    _qname('dc', 'rights'): ('rights', _qname('rdf', 'Alt')),
+    _qname('xmpRights', 'UsageTerms'): ('usage', _qname('rdf', 'Alt')),
+    _qname('dc', 'description'): ('desc', _qname('rdf', 'Alt')),
+}
+
+# Properties that are only read from their rdf:li values, never from the element text.
+SkipElements = ('title', 'subject', 'creator', 'description')
+
+_local_names = {}
+
+
+def _local(qname):
+    """
+    Local part of "{namespace}name", cached since the same names come back for every image.
+    """
+    try:
+        return _local_names[qname]
+    except KeyError:
+        start, end = qname.find('{'), qname.rfind('}')
+        local = qname[:start] + qname[end + 1:] if start != -1 and end > start else qname
+        _local_names[qname] = local
+        return local
+
+
+def parse_xmp(packet, commons_data):
+    """
+    parse_xmp
+    @param packet: XMP packet from the image.
+    @type packet: bytes
+    @param commons_data: Metadata dict with every key present, updated in place.
+    @type commons_data: dict
+
+    :return: returns a JSON object with metadata
+    :rtype: the return type dict
+    """
+    tree = ET.fromstring(packet)
+    elements = []
+    attributes = []
+    lists = {'keywords': [], 'title': [], 'creator': [], 'rights': [], 'usage': [], 'desc': []}
+
+    for rdf in tree:  # One walk over x:xmpmeta/rdf:RDF/rdf:Description
+        if rdf.tag != RDF_TAG:
+            continue
+        for description in rdf:
+            if description.tag != DESCRIPTION_TAG:
+                continue
+            for prop in description:
+                elements.append(prop)
+                list_property = ListProperties.get(prop.tag)
+                if list_property:
+                    for container in prop:
+                        if container.tag == list_property[1]:
+                            lists[list_property[0]].extend(li.text for li in container if li.tag == LI_TAG)
+            attributes.extend(description.attrib.items())
+
+    for prop in elements:  # Simple properties written as elements, mostly in JPG files
+        key = _local(prop.tag)
+        if key not in SkipElements and key in commons_data:
+            if prop.text != '\n' and prop.tag:
+                commons_data[key] = prop.text
+
+    for key, val in attributes:  # Simple properties written as attributes, in JPG and TIF files
+        key = _local(key)
+        if key in commons_data:
+            if val != '\n':
+                commons_data[key] = val
+
+    for keyword in lists['keywords']:
+        commons_data['keywords'].append(keyword)
+
+    if lists['title'] and lists['title'][0]:
+        commons_data['title'] = lists['title'][0]
+
+    for creator in lists['creator']:
+        commons_data['creator'].append(creator)
+
+    for rights in lists['rights'] + lists['usage']:
+        commons_data['rights'].append(rights)
+
+    if lists['desc'] and lists['desc'][0]:
+        commons_data['desc'] = lists['desc'][0]
+
+    return commons_data
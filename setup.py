@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+from setuptools import setup
+
+setup(
+    name='Digitalarkivet2Commons',
+    version='1.0.1',
+    description='Upload images from foto.digitalarkivet.no to Wikimedia Commons',
+    license='MIT',
+    packages=['d2c'],
+    python_requires='>=3.9',
+    install_requires=['Pillow', 'python-dateutil', 'requests>=2.32.3', 'urllib3>=1.26', 'pywikibot>=11.8'],
+    extras_require={'yaml': ['PyYAML']},
+    entry_points={'console_scripts': ['d2c = d2c.cli:main']},
+)